@@ -1,372 +1,782 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from catalog import CacheCatalog
+from chunking import ChunksizeController
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from gzip import GzipFile
-from io import BytesIO, StringIO
+from http.client import HTTPException
+from io import TextIOWrapper
+from itertools import islice
 from logging import INFO
-from more_itertools import consecutive_groups
-from pandas import DataFrame, read_csv
+from shutil import copyfileobj
+from stream import CSVStream
+from tempfile import TemporaryFile
+from tracer import Tracer
+from urllib.error import HTTPError
 
+import csv
 import psycopg2
 import time
 
+# Columns of the geometry store derived from a parsed geometry
+GEOMETRY_COLUMNS = ['geo', 'geo_status', 'bbox', 'area', 'npoints', 'geometry_type']
+
+
+def build_geometry_query(parsed_query):
+    # Wraps a query with a "parsed" geometry column (NULL for empty WKTs) and adds the GEOMETRY_COLUMNS. Invalid geometries
+    # are repaired with ST_MakeValid, keeping the parts of the original dimension, and only dropped if that fails too.
+    # OFFSET 0 keeps PostgreSQL from inlining the subqueries, which would evaluate every function once per reference.
+    return """
+    SELECT checked.*,
+        CASE WHEN parsed IS NULL THEN 'empty' WHEN valid THEN 'valid' WHEN geo IS NOT NULL THEN 'repaired' ELSE 'invalid' END AS geo_status,
+        ST_Envelope(geo) AS bbox, ST_Area(geo) AS area, ST_NPoints(geo) AS npoints, GeometryType(geo) AS geometry_type
+    FROM (
+        SELECT repaired.*, CASE WHEN valid THEN parsed WHEN NOT ST_IsEmpty(fixed) AND ST_IsValid(fixed) THEN fixed END AS geo
+        FROM (
+            SELECT validated.*, CASE WHEN NOT valid THEN ST_CollectionExtract(ST_MakeValid(parsed), ST_Dimension(parsed) + 1) END AS fixed
+            FROM (
+                SELECT parsed_rows.*, ST_IsValid(parsed) AS valid
+                FROM (""" + parsed_query + """) AS parsed_rows
+                OFFSET 0
+            ) AS validated
+            OFFSET 0
+        ) AS repaired
+        OFFSET 0
+    ) AS checked"""
+
 
 class Cache:
-    def __init__(self, logger, config, sparql, type):
+    def __init__(self, logger, config, sparql, type, tracer=None):
         self.config = config
         self.sparql = sparql
         self.type = type
+        self.chunksize_controller = ChunksizeController(config.get_chunksize(type), config.get_max_chunksize(type),
+                                                        config.get_adaptive_chunksize(type), config.get_retries(type))
+        self.catalog = CacheCatalog(config.database_config)
+        self.batch = None
+        self.tracer = tracer if tracer is not None else Tracer()
 
         self.info_logger = logger
 
     def create_cache_file(self):
         connection = psycopg2.connect(self.config.get_database_string())
+        self.create_table(connection)
+
+        with self.tracer.span('download', type=self.type, endpoint='local'):
+            csv_result = self.sparql.query(0)
+
+        self.insert_file(connection, csv_result)
+        csv_result.close()
+
+        if self.config.get_subdivide(self.type) is not None:
+            self.create_pieces(connection)
+
+        self.update_catalog(connection, True)
+        connection.close()
+
+    def create_table(self, connection):
+        # Geometries are kept once per database in geometry_store, keyed by endpoint, uri, WKT digest and source SRID.
+        # members_<hash> lists the geometries of a query with their server offsets and table_<hash> is a view joining
+        # both, which is what the rest of geo-L reads. Members keep a copy of their geometry with a GIST index, so the
+        # spatial joins of a query only probe its own geometries, not those of every cached query.
         cursor = connection.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS {}(\"{}\" VARCHAR, \"{}\" VARCHAR, server_offset BIGINT, geo GEOMETRY)".format(
-            'public.table_' + self.sparql.query_hash, self.config.get_var_uri(self.type), self.config.get_var_shape(self.type)))
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS geometry_store(geometry_id BIGSERIAL PRIMARY KEY, endpoint VARCHAR, uri VARCHAR, wkt_digest CHAR(32),
+            srid INTEGER, shape VARCHAR, geo GEOMETRY, geo_status VARCHAR, bbox GEOMETRY, area DOUBLE PRECISION, npoints INTEGER,
+            geometry_type VARCHAR, UNIQUE (endpoint, uri, wkt_digest, srid))""")
+        # Members record the batch (run) that added them, which incremental mapping compares with the cache version
+        cursor.execute("CREATE TABLE IF NOT EXISTS {}(server_offset BIGINT, geometry_id BIGINT, batch BIGINT, geo GEOMETRY)".format(
+            'public.members_' + self.sparql.query_hash))
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_offset_{} ON {} (server_offset);".format(
+            self.sparql.query_hash, 'members_' + self.sparql.query_hash))
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_geo_{} ON {} USING GIST(geo);".format(
-            self.sparql.query_hash, 'table_' + self.sparql.query_hash))
+            self.sparql.query_hash, 'members_' + self.sparql.query_hash))
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", ('public.table_' + self.sparql.query_hash,))
+        relation = cursor.fetchone()
+
+        if relation is not None and relation[0] == 'r':
+            self.migrate_table(cursor)
+
+        connection.commit()
+
+        if not self.validate_index(connection):
+            self.rebuild_index(connection)
+
+        cursor.execute("""
+        CREATE OR REPLACE VIEW {} AS
+        SELECT members.server_offset, members.geometry_id, store.uri AS "{}", store.shape AS "{}", members.geo, store.geo_status,
+            store.bbox, store.area, store.npoints, store.geometry_type, members.batch
+        FROM {} AS members
+        JOIN geometry_store AS store ON store.geometry_id = members.geometry_id""".format(
+            'public.table_' + self.sparql.query_hash, self.config.get_var_uri(self.type), self.config.get_var_shape(self.type),
+            'members_' + self.sparql.query_hash))
+
+        self.catalog.create_table(cursor)
+        cursor.execute("SELECT to_regclass(%s)", ('public.coverage_' + self.sparql.query_hash,))
+
+        if cursor.fetchone()[0] is None:
+            # Downloaded [range_start, range_end] server offset intervals, merged as chunks complete
+            cursor.execute("CREATE TABLE {}(range_start BIGINT, range_end BIGINT)".format('public.coverage_' + self.sparql.query_hash))
+            cursor.execute("""
+            INSERT INTO {}
+            SELECT MIN(server_offset), MAX(server_offset)
+            FROM (
+                SELECT server_offset, server_offset - DENSE_RANK() OVER (ORDER BY server_offset) AS island
+                FROM {}
+                WHERE server_offset IS NOT NULL
+            ) AS offsets
+            GROUP BY island""".format('coverage_' + self.sparql.query_hash, 'members_' + self.sparql.query_hash))
+
         connection.commit()
         cursor.close()
 
-        result = self.sparql.query(0)
-        csv_result = StringIO(result.decode('utf-8'))
-        self.insert_file(connection, csv_result)
+    def migrate_table(self, cursor):
+        # Moves a cache table of an earlier version, which held its own uris, WKTs, offsets and geometries, into the
+        # geometry store. Its geometries are NULL where the WKT was empty or invalid, those are parsed again below.
+        cursor.execute("""
+        INSERT INTO geometry_store (endpoint, uri, wkt_digest, srid, shape, geo, geo_status)
+        SELECT DISTINCT ON ("{1}", md5(COALESCE("{2}", ''))) %(endpoint)s, "{1}", md5(COALESCE("{2}", '')), %(srid)s, "{2}", geo,
+            CASE WHEN geo IS NULL THEN 'invalid' ELSE 'valid' END
+        FROM {0}
+        WHERE "{1}" IS NOT NULL
+        ON CONFLICT (endpoint, uri, wkt_digest, srid) DO NOTHING""".format(
+            'table_' + self.sparql.query_hash, self.config.get_var_uri(self.type), self.config.get_var_shape(self.type)),
+                       self.get_store_key())
+        cursor.execute("""
+        INSERT INTO {1} (server_offset, geometry_id)
+        SELECT MIN(legacy.server_offset), store.geometry_id
+        FROM {0} AS legacy
+        JOIN geometry_store AS store
+            ON store.endpoint = %(endpoint)s AND store.uri = legacy."{2}" AND store.wkt_digest = md5(COALESCE(legacy."{3}", ''))
+            AND store.srid = %(srid)s
+        GROUP BY store.geometry_id""".format(
+            'table_' + self.sparql.query_hash, 'members_' + self.sparql.query_hash, self.config.get_var_uri(self.type),
+            self.config.get_var_shape(self.type)), self.get_store_key())
+        cursor.execute("DROP TABLE {}".format('table_' + self.sparql.query_hash))
+        cursor.execute("DROP TABLE IF EXISTS {}".format('temp_' + self.sparql.query_hash))
+        self.refresh_geometries(cursor, "geometry_type IS NULL AND geo_status <> 'empty' AND geometry_id IN (SELECT geometry_id FROM {})".format(
+            'members_' + self.sparql.query_hash))
+        cursor.execute("""
+        UPDATE {} AS members
+        SET geo = store.geo
+        FROM geometry_store AS store
+        WHERE store.geometry_id = members.geometry_id""".format('members_' + self.sparql.query_hash))
 
-        connection.close()
+    def refresh_geometries(self, cursor, condition):
+        # Repairs the invalid geometries of earlier versions, parsing their WKT again, and fills in the metadata
+        cursor.execute("""
+        UPDATE geometry_store AS store
+        SET {0}
+        FROM ({1}) AS geometries
+        WHERE store.geometry_id = geometries.geometry_id""".format(
+            ', '.join('{0} = geometries.{0}'.format(column) for column in GEOMETRY_COLUMNS), build_geometry_query("""
+            SELECT geometry_id,
+                CASE WHEN geo_status <> 'invalid' THEN geo
+                    WHEN shape LIKE '%EMPTY' OR shape LIKE '%nan%' THEN NULL
+                    WHEN srid <> 0 THEN ST_Transform(ST_GeomFromText(shape, srid), 4326)
+                    ELSE ST_GeomFromText(shape)
+                END AS parsed
+            FROM geometry_store
+            WHERE {}
+            OFFSET 0""".format(condition))))
+
+    def get_store_key(self):
+        return {'endpoint': self.config.get_endpoint(self.type), 'srid': self.config.get_geo_coding(self.type) or 0}
+
+    def add_coverage(self, cursor, start, end):
+        cursor.execute("DELETE FROM {} WHERE range_end >= %s AND range_start <= %s RETURNING range_start, range_end".format(
+            'coverage_' + self.sparql.query_hash), (start - 1, end + 1))
+
+        for range_start, range_end in cursor.fetchall():
+            start = min(start, range_start)
+            end = max(end, range_end)
+
+        cursor.execute("INSERT INTO {} VALUES (%s, %s)".format('coverage_' + self.sparql.query_hash), (start, end))
+
+    def create_stage_table(self, cursor):
+        # Every chunk is copied into a session local stage table first, so only the rows of that chunk get parsed
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS {}(\"{}\" VARCHAR, \"{}\" VARCHAR, server_offset BIGINT) ON COMMIT DELETE ROWS".format(
+            'stage_' + self.sparql.query_hash, self.config.get_var_uri(self.type), self.config.get_var_shape(self.type)))
 
     def insert_file(self, connection, result):
-        data_frame = read_csv(result)
-        data_frame_column_headers = list(data_frame)
-        column_headers = [self.config.get_var_uri(self.type), self.config.get_var_shape(self.type)]
-        #print("column_headers",column_headers)
-        for data_frame_column_header in data_frame_column_headers:
-            if data_frame_column_header not in column_headers:
-                data_frame.drop(data_frame_column_header, 1, inplace=True)
-
-        output = StringIO()
-        data_frame.to_csv(output, sep=';', index=False)
-        output.seek(0)
-        data_frame_column_headers = list(data_frame)  # TODO: Check if length is 3 and throw exception if not
-        #print("data_frame_column_headers",data_frame_column_headers)
+        stream = CSVStream(result, [self.config.get_var_uri(self.type), self.config.get_var_shape(self.type)], 0)
         cursor = connection.cursor()
-        
-        # first create a temp table and then insert only records whose keys do not yet exist, to avoid duplicates
-        cursor.execute("CREATE TABLE IF NOT EXISTS {} AS SELECT * FROM {} WHERE false".format('temp_' + self.sparql.query_hash,'table_'+self.sparql.query_hash ))
-       
-        cursor.copy_expert(sql="COPY {} (\"{}\", \"{}\") FROM STDIN WITH CSV HEADER DELIMITER AS ';'".format(
-            'temp_' + self.sparql.query_hash, data_frame_column_headers[0], data_frame_column_headers[1]), file=output)
-        
-         
-        cursor.execute("""
-         INSERT INTO {} 
-                SELECT * FROM {}
-                WHERE NOT EXISTS (SELECT 1 FROM {} WHERE {}.{}={}.{});""".format('table_'+self.sparql.query_hash,  'temp_'+self.sparql.query_hash, 'table_'+self.sparql.query_hash, 'table_'+self.sparql.query_hash, self.config.get_var_uri(self.type), 'temp_'+self.sparql.query_hash ,self.config.get_var_uri(self.type) ))
-       
-        cursor.execute("DELETE FROM {};".format('temp_'+self.sparql.query_hash))
+        self.create_stage_table(cursor)
+        self.copy(cursor, stream, 0)
+        self.insert_staged(cursor)
+
+        if stream.size > 0:
+            self.add_coverage(cursor, 0, stream.size - 1)
 
+        connection.commit()
+        cursor.close()
+
+    def copy(self, cursor, stream, offset):
+        # Reading a streamed response happens while COPY consumes it, so for those the span includes the download
+        with self.tracer.span('copy', type=self.type, offset=offset) as span:
+            cursor.copy_expert(sql="COPY {} (\"{}\", \"{}\", server_offset) FROM STDIN WITH CSV DELIMITER AS ';'".format(
+                'stage_' + self.sparql.query_hash, self.config.get_var_uri(self.type), self.config.get_var_shape(self.type)), file=stream)
+            span['rows'] = stream.size
+            span['bytes'] = stream.bytes
+
+    def insert_staged(self, cursor):
+        # Adds the staged geometries the store does not hold yet, parsing and repairing each WKT exactly once and storing
+        # its status and metadata, so rejected rows are never parsed again, then records the chunk's geometries as
+        # members of this query
         if self.config.get_geo_coding(self.type):
-            print('geo')
-            cursor.execute("""
-            UPDATE {} 
-            SET geo = ST_Transform(ST_GeomFromText("{}",{}),4326)
-            WHERE geo IS NULL AND "{}" NOT LIKE '%EMPTY' AND "{}" NOT LIKE '%nan%' AND ST_ISVALID(ST_Transform(ST_GeomFromText("{}",{}),4326))""".format(
-                'table_' + self.sparql.query_hash, self.config.get_var_shape(self.type), self.config.get_geo_coding(self.type),
-                self.config.get_var_shape(self.type), self.config.get_var_shape(self.type), self.config.get_var_shape(self.type),
-                self.config.get_geo_coding(self.type)))
+            geometry = 'ST_Transform(ST_GeomFromText("{}", {}), 4326)'.format(self.config.get_var_shape(self.type),
+                                                                              self.config.get_geo_coding(self.type))
         else:
-            print("no geo")
-            cursor.execute("""
-            UPDATE {} 
-            SET geo = ST_GeomFromText("{}") 
-            WHERE geo IS NULL AND "{}" NOT LIKE '%EMPTY' AND "{}" NOT LIKE '%nan%' AND ST_ISVALID(ST_GeomFromText("{}"))""".format(
-                'table_' + self.sparql.query_hash, self.config.get_var_shape(self.type),
-                self.config.get_var_shape(self.type), self.config.get_var_shape(self.type), self.config.get_var_shape(self.type)))
+            geometry = 'ST_GeomFromText("{}")'.format(self.config.get_var_shape(self.type))
+
+        parsed_query = """
+                SELECT "{1}", "{2}", wkt_digest,
+                    CASE WHEN "{2}" NOT LIKE '%%EMPTY' AND "{2}" NOT LIKE '%%nan%%' THEN {3} END AS parsed
+                FROM (
+                    SELECT DISTINCT ON ("{1}", md5(COALESCE("{2}", ''))) "{1}", "{2}", md5(COALESCE("{2}", '')) AS wkt_digest
+                    FROM {0}
+                    WHERE "{1}" IS NOT NULL
+                ) AS staged
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM geometry_store AS store
+                    WHERE store.endpoint = %(endpoint)s AND store.uri = staged."{1}" AND store.wkt_digest = staged.wkt_digest
+                        AND store.srid = %(srid)s
+                )
+                OFFSET 0""".format('stage_' + self.sparql.query_hash, self.config.get_var_uri(self.type),
+                                   self.config.get_var_shape(self.type), geometry)
+        start = time.time()
+        cursor.execute("""
+        INSERT INTO geometry_store (endpoint, uri, wkt_digest, srid, shape, {2})
+        SELECT %(endpoint)s, "{0}", wkt_digest, %(srid)s, "{1}", {2}
+        FROM ({3}) AS geometries
+        ON CONFLICT (endpoint, uri, wkt_digest, srid) DO NOTHING""".format(
+            self.config.get_var_uri(self.type), self.config.get_var_shape(self.type), ', '.join(GEOMETRY_COLUMNS),
+            build_geometry_query(parsed_query)), self.get_store_key())
+        self.tracer.add('geometry_parse', start, time.time() - start, type=self.type, rows=cursor.rowcount)
+        start = time.time()
+        cursor.execute("""
+        INSERT INTO {1} (server_offset, geometry_id, batch, geo)
+        SELECT MIN(staged.server_offset), store.geometry_id, %(batch)s, store.geo
+        FROM {0} AS staged
+        JOIN geometry_store AS store
+            ON store.endpoint = %(endpoint)s AND store.uri = staged."{2}" AND store.wkt_digest = md5(COALESCE(staged."{3}", ''))
+            AND store.srid = %(srid)s
+        GROUP BY store.geometry_id
+        ON CONFLICT (geometry_id) DO NOTHING""".format(
+            'stage_' + self.sparql.query_hash, 'members_' + self.sparql.query_hash, self.config.get_var_uri(self.type),
+            self.config.get_var_shape(self.type)), dict(self.get_store_key(), batch=self.get_batch(cursor)))
+        self.tracer.add('members', start, time.time() - start, type=self.type, rows=cursor.rowcount)
+
+        # The version is raised in the chunk's transaction, so committed members are never newer than their cache, even
+        # if the run fails before it ends
+        if cursor.rowcount > 0:
+            self.catalog.update_version(cursor, self.sparql.query_hash, self.batch)
+
+    def get_batch(self, cursor):
+        # The batch of this run, drawn from the version sequence on the first insert, becomes the cache's version with
+        # the first chunk that adds members. Stored mapping results are only reused while the version stays the same.
+        if self.batch is None:
+            cursor.execute("SELECT nextval('cache_version')")
+            self.batch = cursor.fetchone()[0]
+
+        return self.batch
+
+    def validate_index(self, connection):
+        cursor = connection.cursor()
+        cursor.execute("""
+        SELECT i.indisunique AND i.indisvalid
+        FROM pg_index i
+        WHERE i.indexrelid = to_regclass(%s) AND i.indrelid = to_regclass(%s)""",
+                       ('public.idx_key_' + self.sparql.query_hash, 'public.members_' + self.sparql.query_hash))
+        result = cursor.fetchone()
+        cursor.close()
+
+        return result is not None and result[0]
+
+    def rebuild_index(self, connection):
+        # Removes duplicate members (the same stored geometry), keeping the one with the lowest server offset, and
+        # recreates the unique index over the geometry ids
+        cursor = connection.cursor()
+        cursor.execute("""
+        DELETE FROM {0}
+        WHERE ctid IN (
+            SELECT ctid
+            FROM (
+                SELECT ctid, ROW_NUMBER() OVER (PARTITION BY geometry_id ORDER BY server_offset) AS position
+                FROM {0}
+            ) AS keys
+            WHERE position > 1
+        )""".format('members_' + self.sparql.query_hash))
+        duplicates = cursor.rowcount
+        cursor.execute("DROP INDEX IF EXISTS {}".format('idx_key_' + self.sparql.query_hash))
+        cursor.execute("CREATE UNIQUE INDEX {} ON {} (geometry_id)".format('idx_key_' + self.sparql.query_hash, 'members_' + self.sparql.query_hash))
         connection.commit()
         cursor.close()
 
+        return duplicates
+
     # INTERNET
 
     def create_cache(self):
         start = time.time()
         offset = self.config.get_offset(self.type)
         limit = self.config.get_limit(self.type)
-        chunksize = self.config.get_chunksize(self.type)
 
         connection = psycopg2.connect(self.config.get_database_string())
-        cursor = connection.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS {}(\"{}\" VARCHAR, \"{}\" VARCHAR, server_offset BIGINT, geo GEOMETRY)".format(
-            'public.table_' + self.sparql.query_hash, self.config.get_var_uri(self.type), self.config.get_var_shape(self.type)))
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_geo_{} ON {} USING GIST(geo);".format(
-            self.sparql.query_hash, 'table_' + self.sparql.query_hash))
-        connection.commit()
-        cursor.close()
+        self.create_table(connection)
 
         self.info_logger.logger.log(INFO, "Checking {} cache".format(self.type))
 
         new_data = False
-        min_offset = offset
-        min_server_offset, max_server_offset = self.find_min_max_server_offset(connection)
+        coverage = self.find_coverage(connection)
+        max_offset = offset + limit - 1 if limit > 0 else None
+        missing_intervals, tail = self.find_missing_data(coverage, offset, max_offset)
 
-        if limit > 0:
-            max_offset = offset + limit - 1
+        if tail is not None:
+            tail = self.check_tail(connection, coverage, tail)
 
-            if (min_server_offset != None and min_server_offset > 0 and max_offset < min_server_offset) or (max_server_offset == None):
-                self.info_logger.logger.log(INFO, "Cache is missing data, downloading missing data...")
-                self.download_results(connection, offset, limit, chunksize)
-                new_data = True
-            elif min_offset > max_server_offset:
-                more_results = self.check_more_results(min_offset + 1)
+        if tail is not None:
+            missing_intervals.append(tail)
 
-                if more_results:
-                    self.info_logger.logger.log(INFO, "Cache is missing data, downloading missing data...")
-                    self.download_results(connection, offset, limit, chunksize)
-                    new_data = True
-            else:
-                intervals = []
+        self.tracer.add('cache_check', start, time.time() - start, type=self.type, missing_intervals=len(missing_intervals))
 
-                if offset < min_server_offset:
-                    intervals.append((offset, min_server_offset - 1))
-                    min_offset = min_server_offset
+        if len(missing_intervals) > 0:
+            self.info_logger.logger.log(INFO, "Cache is missing data, downloading missing data...")
 
-                if max_offset > max_server_offset:
-                    more_results = self.check_more_results(max_server_offset + 1)
+            for interval_offset, interval_max_offset in missing_intervals:
+                interval_limit = -1
 
-                    if more_results:
-                        intervals.append((max_server_offset + 1, max_offset))
+                if interval_max_offset is not None:
+                    interval_limit = interval_max_offset - interval_offset + 1
 
-                    max_offset = max_server_offset
+                self.download_results(connection, interval_offset, interval_limit)
 
-                missing_limit = max_offset - min_offset + 1
+            new_data = True
 
-                missing_intervals = self.find_missing_data(connection, min_offset, missing_limit)
-                missing_intervals = sorted(missing_intervals + intervals)
+        if new_data:
+            end = time.time()
+            self.info_logger.logger.log(INFO, "Retrieving statements took {}s".format(round(end - start, 4)))
+        else:
+            self.info_logger.logger.log(INFO, "Data already cached..")
 
-                if len(missing_intervals) > 0:
-                    self.info_logger.logger.log(INFO, "Cache is missing data, downloading missing data...")
+        geometries_count = self.count_geometries(connection)
+        self.info_logger.logger.log(INFO, "{} repaired, {} invalid and {} empty geometries in {}".format(
+            geometries_count.get('repaired', 0), geometries_count.get('invalid', 0), geometries_count.get('empty', 0), self.type))
 
-                    for interval in missing_intervals:
-                        interval_offset = interval[0]
-                        interval_limit = 1
+        if self.config.get_subdivide(self.type) is not None and self.create_pieces(connection) > 0:
+            new_data = True
 
-                        if len(interval) > 1:
-                            interval_limit = interval[1] - interval_offset + 1
+        self.update_catalog(connection, new_data)
+        connection.close()
 
-                        self.download_results(connection, interval_offset, interval_limit, chunksize)
+    def create_pieces(self, connection):
+        # Splits the cached geometries into pieces of at most subdivide vertices for the mapper. Pieces are only built
+        # for geometries that have none yet, and all are built again if the subdivide setting changed.
+        start = time.time()
+        max_vertices = self.config.get_subdivide(self.type)
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS {}(geometry_id BIGINT, max_vertices INTEGER, piece GEOMETRY)".format(
+            'public.pieces_' + self.sparql.query_hash))
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_piece_{} ON {} USING GIST(piece)".format(
+            self.sparql.query_hash, 'pieces_' + self.sparql.query_hash))
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_piece_id_{} ON {} (geometry_id)".format(
+            self.sparql.query_hash, 'pieces_' + self.sparql.query_hash))
+        cursor.execute("SELECT 1 FROM {} WHERE max_vertices <> %s LIMIT 1".format('pieces_' + self.sparql.query_hash), (max_vertices,))
 
-                    new_data = True
-        else:
-            if max_server_offset == None:
-                self.info_logger.logger.log(INFO, "Cache is missing data, downloading missing data...")
-                self.download_results(connection, offset, limit, chunksize)
-                new_data = True
-            elif min_offset > max_server_offset:
-                more_results = self.check_more_results(min_offset + 1)
+        if cursor.fetchone() is not None:
+            cursor.execute("TRUNCATE {}".format('pieces_' + self.sparql.query_hash))
 
-                if more_results:
-                    self.info_logger.logger.log(INFO, "Cache is missing data, downloading missing data...")
-                    self.download_results(connection, offset, limit, chunksize)
-                    new_data = True
-            elif min_offset < min_server_offset:
-                missing_interval = [(min_offset, min_server_offset - 1)]
-                missing_intervals = self.find_missing_data(connection, min_offset, missing_limit)
-                missing_intervals = missing_interval + missing_intervals
-                more_results = self.check_more_results(max_server_offset + 1)
+        cursor.execute("""
+        INSERT INTO {0} (geometry_id, max_vertices, piece)
+        SELECT members.geometry_id, %s, ST_Subdivide(members.geo, %s)
+        FROM {1} AS members
+        WHERE members.geo IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {0} AS pieces WHERE pieces.geometry_id = members.geometry_id)""".format(
+            'pieces_' + self.sparql.query_hash, 'members_' + self.sparql.query_hash), (max_vertices, max_vertices))
+        pieces = cursor.rowcount
 
-                if more_results:
-                    missing_intervals + [(max_server_offset + 1,)]
+        self.tracer.add('subdivide', start, time.time() - start, type=self.type, rows=pieces)
 
-                self.info_logger.logger.log(INFO, "Cache is missing data, downloading missing data...")
+        if pieces > 0:
+            cursor.execute("ANALYZE {}".format('pieces_' + self.sparql.query_hash))
+            self.info_logger.logger.log(INFO, "Subdividing {} geometries into {} pieces took {}s".format(
+                self.type, pieces, round(time.time() - start, 4)))
 
-                for interval in missing_intervals:
-                    interval_offset = interval[0]
-                    interval_limit = -1
+        connection.commit()
+        cursor.close()
 
-                    if len(interval) > 1:
-                        interval_limit = interval[1] - interval_offset + 1
+        return pieces
 
-                    self.download_results(connection, interval_offset, interval_limit, chunksize)
+    def update_catalog(self, connection, new_data):
+        cursor = connection.cursor()
+        self.catalog.hit(cursor, self.sparql.query_hash, self.config.get_endpoint(self.type))
 
-                new_data = True
-            else:
-                missing_intervals = self.find_missing_data(connection, min_offset, max_server_offset)
-                more_results = self.check_more_results(max_server_offset + 1)
+        if new_data:
+            self.catalog.update_size(cursor, self.sparql.query_hash)
 
-                if more_results:
-                    missing_intervals += [(max_server_offset + 1,)]
+        connection.commit()
+        cursor.close()
 
-                if len(missing_intervals) > 0:
-                    self.info_logger.logger.log(INFO, "Cache is missing data, downloading missing data...")
+    def check_tail(self, connection, coverage, tail):
+        # Works out how much of the uncovered tail exists on the endpoint. A result count recorded within end_ttl seconds
+        # answers that without a request. Otherwise the count strategy asks for the count once, the probe strategy
+        # asks for one row after the cached data and the page strategy lets the download stop at the first short page.
+        total = self.find_total(connection)
 
-                    for interval in missing_intervals:
-                        interval_offset = interval[0]
-                        interval_limit = -1
+        if total is None and self.config.get_end_detection(self.type) == 'count':
+            total = self.count_results()
+            self.record_total(connection, total)
 
-                        if len(interval) > 1:
-                            interval_limit = interval[1] - interval_offset + 1
+        if total is not None:
+            if tail[0] >= total:
+                return None
 
-                        self.download_results(connection, interval_offset, interval_limit, chunksize)
+            if tail[1] is None or tail[1] >= total:
+                return tail[0], total - 1
 
-                    new_data = True
+            return tail
 
-        if new_data:
-            end = time.time()
-            self.info_logger.logger.log(INFO, "Retrieving statements took {}s".format(round(end - start, 4)))
-        else:
-            self.info_logger.logger.log(INFO, "Data already cached..")
+        if self.config.get_end_detection(self.type) == 'probe' and len(coverage) > 0:
+            if not self.check_more_results(tail[0], self.find_keyset_cursor(connection, tail[0])):
+                return None
 
-        invalid_geometries_count = self.count_invalid_geometries(connection)
-        self.info_logger.logger.log(INFO, "{} invalid geometries in {}".format(invalid_geometries_count, self.type))
+        return tail
 
-        connection.close()
+    def find_total(self, connection):
+        end_ttl = self.config.get_end_ttl(self.type)
 
-    def download_results(self, connection, offset, limit, chunksize):
-        start_offset = offset
-        run = True
+        if end_ttl == 0:
+            return None
 
-        while(run):
-            current_max = offset + chunksize
+        cursor = connection.cursor()
+        cursor.execute("""
+        SELECT total_rows FROM cache_catalog
+        WHERE query_hash = %s AND total_rows IS NOT NULL AND total_checked_at > NOW() - %s * INTERVAL '1 second'""",
+                       (self.sparql.query_hash, end_ttl))
+        result = cursor.fetchone()
+        cursor.close()
 
-            if limit > 0 and offset + chunksize >= start_offset + limit:
-                chunksize = start_offset + limit - offset
-                current_max = start_offset + limit
-                run = False
+        return result[0] if result is not None else None
 
-            self.info_logger.logger.log(INFO, "Getting statements from {} to {}".format(offset, current_max))
-            result = self.sparql.query(offset, chunksize)  # TODO: Retry if 502 (Exception and retry counter)
-            result_info = result.info()
+    def record_total(self, connection, total):
+        cursor = connection.cursor()
+        cursor.execute("""
+        INSERT INTO cache_catalog (query_hash, total_rows, total_checked_at) VALUES (%s, %s, NOW())
+        ON CONFLICT (query_hash) DO UPDATE SET total_rows = EXCLUDED.total_rows, total_checked_at = EXCLUDED.total_checked_at""",
+                       (self.sparql.query_hash, total))
+        connection.commit()
+        cursor.close()
 
-            if 'x-sparql-maxrows' in result_info:
-                max_chunksize_server = int(result_info['x-sparql-maxrows'])
+    def count_results(self):
+        result = self.sparql.query_count()
+        csv_result = self.decode_response(result.response, result.info())
+        rows = list(islice(csv.reader(csv_result), 2))
+        result.response.close()
 
-                if max_chunksize_server and max_chunksize_server < chunksize:
-                    chunksize = max_chunksize_server
-                    self.info_logger.logger.log(
-                        INFO, "Max server rows is smaller than chunksize, new chunksize is {}".format(max_chunksize_server))
+        return int(rows[1][0])
 
-            if 'content-encoding' in result_info and result_info['content-encoding'] == 'gzip':
-                csv_result = self.gunzip_response(result)
-            else:
-                csv_result = StringIO(result.convert().decode('utf-8'))
+    def download_results(self, connection, offset, limit):
+        workers = self.config.get_workers(self.type)
 
-            result.response.close()
-            size = self.insert(connection, csv_result, offset, chunksize)
+        if workers > 1 and self.config.get_paging(self.type) == 'keyset':
+            self.info_logger.logger.log(INFO, "Keyset paging needs the previous page, downloading {} chunks one by one".format(self.type))
+        elif workers > 1:
+            self.download_results_concurrent(connection, offset, limit, workers)
+            return
+
+        end_offset = offset + limit if limit > 0 else None
+        after = self.find_keyset_cursor(connection, offset)
+
+        while end_offset is None or offset < end_offset:
+            chunksize = self.chunksize_controller.chunksize
+
+            if end_offset is not None:
+                chunksize = min(chunksize, end_offset - offset)
+
+            self.info_logger.logger.log(INFO, "Getting statements from {} to {}".format(offset, offset + chunksize))
+            start = time.time()
+
+            try:
+                response, csv_result, max_chunksize_server = self.fetch(offset, chunksize, after=after)
+
+                try:
+                    stream = self.insert(connection, csv_result, offset, chunksize)
+                finally:
+                    response.close()
+            except Exception as e:
+                connection.rollback()
+                self.retry(e)
+                continue
+
+            if max_chunksize_server:
+                self.limit_chunksize(max_chunksize_server)
+                chunksize = min(chunksize, max_chunksize_server)
+
+            self.update_chunksize(chunksize, stream.size, time.time() - start)
 
-            if size < chunksize:
+            if stream.size < chunksize:
+                self.record_total(connection, offset + stream.size)
                 break
 
-            offset = offset + chunksize
+            if after is not None and stream.last == after[0] and stream.last_count == stream.size:
+                after = (after[0], after[1] + stream.size)
+            elif self.config.get_paging(self.type) == 'keyset':
+                after = (stream.last, stream.last_count)
 
-    def insert(self, connection, result, offset, chunksize):
-        data_frame = read_csv(result)
-        data_frame['server_offset'] = range(offset, offset + len(data_frame))
-        data_frame_column_headers = list(data_frame)
-        column_headers = [self.config.get_var_uri(self.type), self.config.get_var_shape(self.type), 'server_offset']
+            offset = offset + stream.size
+
+    def limit_chunksize(self, max_chunksize_server):
+        if self.chunksize_controller.limit(max_chunksize_server):
+            self.info_logger.logger.log(
+                INFO, "Max server rows is smaller than chunksize, new chunksize is {}".format(max_chunksize_server))
+
+    def update_chunksize(self, chunksize, size, elapsed):
+        if self.chunksize_controller.success(chunksize, size, elapsed):
+            self.info_logger.logger.log(INFO, "Chunksize for {} settled at {}".format(
+                self.config.get_endpoint(self.type), self.chunksize_controller.chunksize))
+
+    def retry(self, error):
+        # Timeouts, dropped connections and server errors are retried with backoff (and a smaller chunk size in
+        # adaptive mode), everything else is raised
+        if isinstance(error, HTTPError):
+            retryable = error.code >= 500
+        else:
+            retryable = isinstance(error, (OSError, HTTPException, EOFError))
 
-        for data_frame_column_header in data_frame_column_headers:
-            if data_frame_column_header not in column_headers:
-                data_frame.drop(data_frame_column_header, 1, inplace=True)
+        delay = self.chunksize_controller.failure() if retryable else None
 
-        size = len(data_frame)
+        if delay is None:
+            raise error
 
-        output = StringIO()
-        data_frame.to_csv(output, sep=';', index=False)
-        output.seek(0)
-        data_frame_column_headers = list(data_frame)  # TODO: Check if length is 3 and throw exception if not
+        self.info_logger.logger.log(INFO, "Request failed ({}), retrying in {}s with chunksize {}".format(
+            error, delay, self.chunksize_controller.chunksize))
+        time.sleep(delay)
+
+    def find_keyset_cursor(self, connection, offset):
+        # Keyset paging continues after the uri stored at offset - 1, skipping the rows with that uri already cached.
+        # Without that row, the page is requested by offset instead.
+        if self.config.get_paging(self.type) != 'keyset' or offset == 0:
+            return None
 
         cursor = connection.cursor()
-        cursor.copy_expert(sql="COPY {} (\"{}\", \"{}\", \"{}\") FROM STDIN WITH CSV HEADER DELIMITER AS ';'".format(
-            'table_' + self.sparql.query_hash, data_frame_column_headers[0], data_frame_column_headers[1], data_frame_column_headers[2]),
-            file=output)
+        cursor.execute("SELECT server_offset, \"{}\" FROM {} WHERE server_offset < %s ORDER BY server_offset DESC LIMIT 1000".format(
+            self.config.get_var_uri(self.type), 'table_' + self.sparql.query_hash), (offset,))
+        result = cursor.fetchall()
+        cursor.close()
 
-        if self.config.get_geo_coding(self.type):
-            cursor.execute("""
-            UPDATE {} 
-            SET geo = ST_Transform(ST_GeomFromText("{}",{}),4326)
-            WHERE geo IS NULL AND "{}" NOT LIKE '%EMPTY' AND "{}" NOT LIKE '%nan%' AND ST_ISVALID(ST_Transform(ST_GeomFromText("{}",{}),4326))""".format(
-                'table_' + self.sparql.query_hash, self.config.get_var_shape(self.type), self.config.get_geo_coding(self.type),
-                self.config.get_var_shape(self.type), self.config.get_var_shape(self.type), self.config.get_var_shape(self.type),
-                self.config.get_geo_coding(self.type)))
+        if len(result) == 0 or result[0][0] != offset - 1:
+            return None
+
+        count = 0
+
+        for _, uri in result:
+            if uri != result[0][1]:
+                break
+
+            count += 1
+
+        return result[0][1], count
+
+    def download_results_concurrent(self, connection, offset, limit, workers):
+        # Keeps up to `workers` offset windows in flight and inserts every page as soon as it arrives. Pages can complete
+        # out of order, so the end of the data is the smallest offset at which a page came back short.
+        end_offset = offset + limit if limit > 0 else None
+        next_offset = offset
+        stop_offset = None
+        retry_windows = []
+        windows = {}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                while len(windows) < workers:
+                    if len(retry_windows) > 0:
+                        window_offset, window_size = retry_windows.pop(0)
+
+                        if stop_offset is not None and window_offset >= stop_offset:
+                            continue
+                    else:
+                        if end_offset is not None and next_offset >= end_offset:
+                            break
+
+                        if stop_offset is not None and next_offset >= stop_offset:
+                            break
+
+                        window_offset = next_offset
+                        window_size = self.chunksize_controller.chunksize
+
+                        if end_offset is not None:
+                            window_size = min(window_size, end_offset - next_offset)
+
+                        next_offset = next_offset + window_size
+
+                    self.info_logger.logger.log(INFO, "Getting statements from {} to {}".format(window_offset, window_offset + window_size))
+                    future = executor.submit(self.fetch, window_offset, window_size, True)
+                    windows[future] = (window_offset, window_size, time.time())
+
+                if len(windows) == 0:
+                    break
+
+                done, _ = wait(windows, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    window_offset, window_size, start = windows.pop(future)
+
+                    try:
+                        response, csv_result, max_chunksize_server = future.result()
+
+                        try:
+                            size = self.insert(connection, csv_result, window_offset, window_size).size
+                        finally:
+                            response.close()
+                    except Exception as e:
+                        connection.rollback()
+                        self.retry(e)
+
+                        # The failed range is requested again in windows of the chunk size after the failure
+                        retry_size = self.chunksize_controller.chunksize
+                        retry_windows += [(retry_offset, min(retry_size, window_offset + window_size - retry_offset))
+                                          for retry_offset in range(window_offset, window_offset + window_size, retry_size)]
+                        continue
+
+                    if max_chunksize_server:
+                        self.limit_chunksize(max_chunksize_server)
+
+                    self.update_chunksize(window_size, size, time.time() - start)
+
+                    if size < window_size:
+                        if size > 0 and size == max_chunksize_server:
+                            # The server truncated the page, request the rest of the window again
+                            retry_windows.append((window_offset + size, window_size - size))
+                        elif stop_offset is None or window_offset + size < stop_offset:
+                            stop_offset = window_offset + size
+
+        if stop_offset is not None:
+            self.record_total(connection, stop_offset)
+
+    def fetch(self, offset, chunksize, spool=False, after=None):
+        # Returns the response body, a text stream decoding it while it is read and the server row limit, if any.
+        # Spooled responses are downloaded to a temporary file first, so a worker thread can fetch the next chunk while
+        # this one is inserted.
+        start = time.time()
+        result = self.sparql.query(offset, chunksize, after)
+        result_info = result.info()
+
+        if result.timing['reused']:
+            connection_info = "connection reused"
         else:
-            cursor.execute("""
-            UPDATE {} 
-            SET geo = ST_GeomFromText("{}") 
-            WHERE geo IS NULL AND "{}" NOT LIKE '%EMPTY' AND "{}" NOT LIKE '%nan%' AND ST_ISVALID(ST_GeomFromText("{}"))""".format(
-                'table_' + self.sparql.query_hash, self.config.get_var_shape(self.type),
-                self.config.get_var_shape(self.type), self.config.get_var_shape(self.type), self.config.get_var_shape(self.type)))
+            connection_info = "new connection, connecting took {}s".format(round(result.timing['connect'], 4))
+
+        self.info_logger.logger.log(INFO, "Response for offset {} after {}s ({})".format(offset, round(result.timing['response'], 4),
+                                                                                       connection_info))
+        response = result.response
+        max_chunksize_server = None
+
+        if 'x-sparql-maxrows' in result_info:
+            max_chunksize_server = int(result_info['x-sparql-maxrows'])
+
+        if spool:
+            response = TemporaryFile()
+            copyfileobj(result.response, response)
+            result.response.close()
+            response_bytes = response.tell()
+            response.seek(0)
+        elif 'content-length' in result_info:
+            response_bytes = int(result_info['content-length'])
+        else:
+            response_bytes = None
+
+        # Spooled responses are read completely here, streamed ones only until the first bytes arrive
+        self.tracer.add('download', start, time.time() - start, type=self.type, offset=offset, chunksize=chunksize, bytes=response_bytes,
+                        reused=result.timing['reused'], spooled=spool)
+
+        return response, self.decode_response(response, result_info), max_chunksize_server
+
+    def decode_response(self, response, result_info):
+        if 'content-encoding' in result_info and result_info['content-encoding'] == 'gzip':
+            return self.gunzip_response(response)
+
+        return TextIOWrapper(response, encoding='utf-8', newline='')
+
+    def insert(self, connection, result, offset, chunksize):
+        stream = CSVStream(result, [self.config.get_var_uri(self.type), self.config.get_var_shape(self.type)], offset)
+
+        cursor = connection.cursor()
+        self.create_stage_table(cursor)
+        self.copy(cursor, stream, offset)
+        self.insert_staged(cursor)
+
+        if stream.size > 0:
+            self.add_coverage(cursor, offset, offset + stream.size - 1)
+
         connection.commit()
         cursor.close()
 
-        return size
+        return stream
 
     def gunzip_response(self, response):
-        buffer = BytesIO()
-        buffer.write(response.response.read())
-        buffer.seek(0)
-
-        with GzipFile(fileobj=buffer, mode='rb') as unzipped:
-            result = unzipped.read()
-            return StringIO(result.decode('utf-8'))
+        return TextIOWrapper(GzipFile(fileobj=response, mode='rb'), encoding='utf-8', newline='')
 
     def find_min_max_server_offset(self, connection):
         cursor = connection.cursor()
-        cursor.execute("SELECT MIN(server_offset), MAX(server_offset) FROM {}".format('table_' + self.sparql.query_hash))
+        cursor.execute("SELECT MIN(range_start), MAX(range_end) FROM {}".format('coverage_' + self.sparql.query_hash))
         result = cursor.fetchone()
         cursor.close()
 
         return result[0], result[1]
 
-    def find_missing_data(self, connection, offset, limit):
+    def find_coverage(self, connection):
         cursor = connection.cursor()
-        cursor.execute("""
-        SELECT s.i AS missing 
-        FROM generate_series({}, {}) s(i) 
-        WHERE NOT EXISTS (
-            SELECT 1 FROM {} WHERE server_offset = s.i 
-        ) 
-        ORDER BY missing
-        """.format(offset, offset + limit - 1, 'table_' + self.sparql.query_hash))
+        cursor.execute("SELECT range_start, range_end FROM {} ORDER BY range_start".format('coverage_' + self.sparql.query_hash))
         result = cursor.fetchall()
         cursor.close()
 
-        missing_values = [x[0] for x in result]
-        missing_intervals = list(self.find_ranges(missing_values))
+        return result
 
-        return missing_intervals
+    def find_missing_data(self, coverage, offset, max_offset=None):
+        # Returns the gaps of the coverage between offset and max_offset and the uncovered tail after the last cached
+        # interval, if any. max_offset None means the range is open ended, as is the end of an open ended tail.
+        missing_intervals = []
+        current_offset = offset
 
-    def find_ranges(self, iterable):
-        for group in consecutive_groups(iterable):
-            group = list(group)
-            if len(group) == 1:
-                yield group[0]
-            else:
-                yield group[0], group[-1]
+        for range_start, range_end in coverage:
+            if range_end < current_offset:
+                continue
 
-    def check_more_results(self, offset):
-        result = self.sparql.query(offset, 1)
-        result_info = result.info()
+            if max_offset is not None and range_start > max_offset:
+                break
 
-        if 'content-encoding' in result_info and result_info['content-encoding'] == 'gzip':
-            csv_result = self.gunzip_response(result)
-        else:
-            csv_result = StringIO(result.convert().decode('utf-8'))
+            if range_start > current_offset:
+                missing_intervals.append((current_offset, range_start - 1))
+
+            current_offset = range_end + 1
+
+        tail = None
 
-        data_frame = read_csv(csv_result)
-        return len(data_frame) == 1
+        if max_offset is None or current_offset <= max_offset:
+            tail = (current_offset, max_offset)
 
-    def count_invalid_geometries(self, connection):
+        return missing_intervals, tail
+
+    def check_more_results(self, offset, after=None):
+        response, csv_result, _ = self.fetch(offset, 1, after=after)
+        rows = list(islice(csv.reader(csv_result), 2))
+        response.close()
+
+        return len(rows) == 2
+
+    def count_geometries(self, connection):
         offset = self.config.get_offset(self.type)
         limit = self.config.get_limit(self.type)
-        query = "SELECT COUNT(*) AS count FROM {} WHERE geo IS NULL".format('table_' + self.sparql.query_hash)
+        query = "SELECT geo_status, COUNT(*) AS count FROM {}".format('table_' + self.sparql.query_hash)
 
         if limit > 0:
-            query += " AND server_offset BETWEEN {} AND {}".format(offset, limit)
+            query += " WHERE server_offset BETWEEN {} AND {}".format(offset, offset + limit - 1)
         else:
-            query += " AND server_offset >= {}".format(offset)
+            query += " WHERE server_offset >= {}".format(offset)
 
         cursor = connection.cursor()
-        cursor.execute(query)
-        result = cursor.fetchone()
+        cursor.execute(query + " GROUP BY geo_status")
+        result = dict(cursor.fetchall())
         cursor.close()
 
-        return result[0]
+        return result
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from config import ConfigNotValidError, get_database_string
+
+import psycopg2
+import re
+
+# Query hashes are md5 digests, the table names of a cache are built from them
+QUERY_HASH_PATTERN = '[0-9a-f]{32}'
+
+# A cache exists while any of its tables does. Caches of earlier versions have a table_<hash> base table, next to a
+# temp_<hash> staging table, instead of members_<hash> and a table_<hash> view.
+CACHE_EXISTS = """(to_regclass('members_' || query_hash) IS NOT NULL OR to_regclass('table_' || query_hash) IS NOT NULL
+    OR to_regclass('temp_' || query_hash) IS NOT NULL)"""
+
+
+def check_query_hash(query_hash):
+    if not isinstance(query_hash, str) or re.fullmatch(QUERY_HASH_PATTERN, query_hash) is None:
+        raise ValueError("Query hash {!r} is not valid".format(query_hash))
+
+
+# Bookkeeping of the caches in a database. Every cache has a row in cache_catalog with its endpoint, cached row count,
+# size, creation time and last hit. Caches are evicted when they were not hit for cache_ttl seconds, and least recently
+# hit caches are evicted while the caches together use more than cache_budget bytes.
+class CacheCatalog:
+    def __init__(self, database_config):
+        self.database_config = database_config
+
+        if 'cache_budget' in database_config and (not isinstance(database_config['cache_budget'], int) or database_config['cache_budget'] < 0):
+            raise ConfigNotValidError("Cache budget must be a positive integer")
+
+        if 'cache_ttl' in database_config and (not isinstance(database_config['cache_ttl'], (int, float)) or database_config['cache_ttl'] < 0):
+            raise ConfigNotValidError("Cache ttl must be a positive number")
+
+    def get_cache_budget(self):
+        if 'cache_budget' in self.database_config:
+            return self.database_config['cache_budget']
+        else:
+            return None
+
+    def get_cache_ttl(self):
+        if 'cache_ttl' in self.database_config:
+            return self.database_config['cache_ttl']
+        else:
+            return None
+
+    def connect(self):
+        connection = psycopg2.connect(get_database_string(self.database_config))
+        cursor = connection.cursor()
+        self.create_table(cursor)
+        connection.commit()
+        cursor.close()
+
+        return connection
+
+    def create_table(self, cursor):
+        cursor.execute("CREATE SEQUENCE IF NOT EXISTS cache_version")
+        cursor.execute("CREATE TABLE IF NOT EXISTS cache_catalog(query_hash VARCHAR PRIMARY KEY, total_rows BIGINT, total_checked_at TIMESTAMP)")
+        cursor.execute("""
+        ALTER TABLE cache_catalog
+            ADD COLUMN IF NOT EXISTS endpoint VARCHAR,
+            ADD COLUMN IF NOT EXISTS row_count BIGINT,
+            ADD COLUMN IF NOT EXISTS size_bytes BIGINT,
+            ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT NOW(),
+            ADD COLUMN IF NOT EXISTS last_hit TIMESTAMP,
+            ADD COLUMN IF NOT EXISTS version BIGINT DEFAULT nextval('cache_version')""")
+
+    def hit(self, cursor, query_hash, endpoint):
+        cursor.execute("""
+        INSERT INTO cache_catalog (query_hash, endpoint, created_at, last_hit) VALUES (%s, %s, NOW(), NOW())
+        ON CONFLICT (query_hash) DO UPDATE SET endpoint = EXCLUDED.endpoint, last_hit = EXCLUDED.last_hit""", (query_hash, endpoint))
+
+    def update_version(self, cursor, query_hash, version):
+        # Versions come from a sequence, so a cache that is evicted and created again never repeats one. They only grow,
+        # a run that drew its batch before another run committed does not lower the version.
+        cursor.execute("""
+        INSERT INTO cache_catalog (query_hash, created_at, version) VALUES (%s, NOW(), %s)
+        ON CONFLICT (query_hash) DO UPDATE SET version = GREATEST(cache_catalog.version, EXCLUDED.version)""", (query_hash, version))
+
+    def get_version(self, cursor, query_hash):
+        cursor.execute("SELECT version FROM cache_catalog WHERE query_hash = %s", (query_hash,))
+        result = cursor.fetchone()
+
+        return result[0] if result is not None else None
+
+    def get_relkind(self, cursor, relation):
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", ('public.' + relation,))
+        result = cursor.fetchone()
+
+        return result[0] if result is not None else None
+
+    def update_size(self, cursor, query_hash):
+        # The size counts the cache's own tables and the stored geometries it references, so geometries shared
+        # between caches count towards each of them
+        check_query_hash(query_hash)
+
+        if self.get_relkind(cursor, 'members_' + query_hash) is None:
+            # Caches of earlier versions hold their geometries in their own tables
+            row_count = 'NULL'
+
+            if self.get_relkind(cursor, 'table_' + query_hash) == 'r':
+                row_count = '(SELECT COUNT(*) FROM {})'.format('table_' + query_hash)
+
+            cursor.execute("""
+            UPDATE cache_catalog
+            SET row_count = {},
+                size_bytes = COALESCE(pg_total_relation_size(to_regclass(%(table)s)), 0) + COALESCE(pg_total_relation_size(to_regclass(%(temp)s)), 0)
+            WHERE query_hash = %(query_hash)s""".format(row_count),
+                           {'table': 'table_' + query_hash, 'temp': 'temp_' + query_hash, 'query_hash': query_hash})
+            return
+
+        cursor.execute("""
+        UPDATE cache_catalog
+        SET row_count = members.row_count,
+            size_bytes = members.geometry_bytes + pg_total_relation_size(%(members)s) + COALESCE(pg_total_relation_size(to_regclass(%(coverage)s)), 0)
+                + COALESCE(pg_total_relation_size(to_regclass(%(pieces)s)), 0)
+        FROM (
+            SELECT COUNT(*) AS row_count, COALESCE(SUM(pg_column_size(store.shape) + COALESCE(pg_column_size(store.geo), 0)), 0) AS geometry_bytes
+            FROM {} AS members
+            JOIN geometry_store AS store ON store.geometry_id = members.geometry_id
+        ) AS members
+        WHERE query_hash = %(query_hash)s""".format('members_' + query_hash),
+                       {'members': 'members_' + query_hash, 'coverage': 'coverage_' + query_hash, 'pieces': 'pieces_' + query_hash,
+                        'query_hash': query_hash})
+
+    def list_caches(self):
+        connection = self.connect()
+        cursor = connection.cursor()
+        self.register_caches(cursor)
+        connection.commit()
+        cursor.execute("""
+        SELECT query_hash, endpoint, row_count, size_bytes, created_at, last_hit
+        FROM cache_catalog
+        WHERE {}
+        ORDER BY last_hit DESC NULLS LAST""".format(CACHE_EXISTS))
+        caches = [{'query_hash': row[0], 'endpoint': row[1], 'rows': row[2], 'size': row[3],
+                   'created_at': row[4].isoformat() if row[4] is not None else None,
+                   'last_hit': row[5].isoformat() if row[5] is not None else None} for row in cursor.fetchall()]
+        cursor.close()
+        connection.close()
+
+        return caches
+
+    def register_caches(self, cursor):
+        # Adds caches created before the catalog, including the tables of earlier versions, or whose size was never
+        # measured
+        cursor.execute("""
+        SELECT DISTINCT tables.query_hash, members.oid IS NOT NULL
+        FROM (
+            SELECT substring(relname FROM '_(.*)$') AS query_hash
+            FROM pg_class
+            WHERE relname ~ %s AND relkind = 'r' AND relnamespace = 'public'::regnamespace
+        ) AS tables
+        LEFT JOIN cache_catalog ON cache_catalog.query_hash = tables.query_hash
+        LEFT JOIN pg_class AS members ON members.oid = to_regclass('public.members_' || tables.query_hash)
+        WHERE cache_catalog.query_hash IS NULL OR cache_catalog.size_bytes IS NULL""", ('^(members|table|temp)_{}$'.format(QUERY_HASH_PATTERN),))
+
+        for query_hash, has_members in cursor.fetchall():
+            if has_members:
+                cursor.execute("""
+                INSERT INTO cache_catalog (query_hash, endpoint, created_at)
+                SELECT %s, MIN(store.endpoint), NOW()
+                FROM (SELECT geometry_id FROM {} LIMIT 1) AS members
+                JOIN geometry_store AS store ON store.geometry_id = members.geometry_id
+                ON CONFLICT (query_hash) DO NOTHING""".format('members_' + query_hash), (query_hash,))
+            else:
+                # The tables of earlier versions do not record their endpoint
+                cursor.execute("""
+                INSERT INTO cache_catalog (query_hash, created_at) VALUES (%s, NOW())
+                ON CONFLICT (query_hash) DO NOTHING""", (query_hash,))
+
+            self.update_size(cursor, query_hash)
+
+    def evict(self, query_hashes=None, keep=()):
+        # Evicts the given caches, or the caches the eviction policy selects if none are given, except those in keep
+        for query_hash in query_hashes or []:
+            check_query_hash(query_hash)
+
+        connection = self.connect()
+        cursor = connection.cursor()
+        self.register_caches(cursor)
+        connection.commit()
+
+        if query_hashes is None:
+            query_hashes = self.select_evictions(cursor)
+
+        evicted = []
+
+        for query_hash in query_hashes:
+            if query_hash in keep:
+                continue
+
+            if all(self.get_relkind(cursor, table + query_hash) is None for table in ['members_', 'table_', 'temp_']):
+                continue
+
+            self.drop_cache(cursor, query_hash)
+            connection.commit()
+            evicted.append(query_hash)
+
+        cursor.close()
+        connection.close()
+
+        return evicted
+
+    def select_evictions(self, cursor):
+        query_hashes = []
+
+        if self.get_cache_ttl() is not None:
+            cursor.execute("""
+            SELECT query_hash FROM cache_catalog
+            WHERE COALESCE(last_hit, created_at) < NOW() - %s * INTERVAL '1 second'""", (self.get_cache_ttl(),))
+            query_hashes += [row[0] for row in cursor.fetchall()]
+
+        if self.get_cache_budget() is not None:
+            # Walks the caches from the most recently hit one and evicts everything past the budget
+            cursor.execute("""
+            SELECT query_hash
+            FROM (
+                SELECT query_hash, SUM(COALESCE(size_bytes, 0)) OVER (ORDER BY COALESCE(last_hit, created_at) DESC, query_hash) AS used
+                FROM cache_catalog
+                WHERE {}
+            ) AS caches
+            WHERE used > %s""".format(CACHE_EXISTS), (self.get_cache_budget(),))
+            query_hashes += [row[0] for row in cursor.fetchall() if row[0] not in query_hashes]
+
+        return query_hashes
+
+    def drop_cache(self, cursor, query_hash):
+        # Geometries of the store are removed with the last cache that references them
+        check_query_hash(query_hash)
+
+        if self.get_relkind(cursor, 'members_' + query_hash) is not None:
+            cursor.execute("""
+            SELECT relname
+            FROM pg_class
+            WHERE relname LIKE %s AND relname <> %s AND relkind = 'r' AND relnamespace = 'public'::regnamespace""",
+                           ('members\\_%', 'members_' + query_hash))
+            others = ''.join(' AND NOT EXISTS (SELECT 1 FROM {} AS other WHERE other.geometry_id = store.geometry_id)'.format(row[0])
+                             for row in cursor.fetchall())
+            cursor.execute("""
+            DELETE FROM geometry_store AS store
+            WHERE store.geometry_id IN (SELECT geometry_id FROM {}){}""".format('members_' + query_hash, others))
+
+        # table_<hash> is a view, or the base table of a cache of an earlier version
+        if self.get_relkind(cursor, 'table_' + query_hash) == 'v':
+            cursor.execute("DROP VIEW {}".format('table_' + query_hash))
+        else:
+            cursor.execute("DROP TABLE IF EXISTS {}".format('table_' + query_hash))
+
+        for table in ['members_', 'temp_', 'coverage_', 'pieces_']:
+            cursor.execute("DROP TABLE IF EXISTS {}".format(table + query_hash))
+        cursor.execute("DELETE FROM cache_catalog WHERE query_hash = %s", (query_hash,))
+        cursor.execute("SELECT to_regclass('public.mapping_results')")
+
+        if cursor.fetchone()[0] is not None:
+            cursor.execute("""
+            DELETE FROM mapping_links
+            WHERE input_key IN (SELECT input_key FROM mapping_results WHERE source_hash = %(query_hash)s OR target_hash = %(query_hash)s)""",
+                           {'query_hash': query_hash})
+            cursor.execute("DELETE FROM mapping_results WHERE source_hash = %(query_hash)s OR target_hash = %(query_hash)s",
+                           {'query_hash': query_hash})
+
+        cursor.execute("SELECT to_regclass('public.incremental_state')")
+
+        if cursor.fetchone()[0] is not None:
+            cursor.execute("""
+            DELETE FROM incremental_links
+            WHERE input_key IN (SELECT input_key FROM incremental_state WHERE source_hash = %(query_hash)s OR target_hash = %(query_hash)s)""",
+                           {'query_hash': query_hash})
+            cursor.execute("DELETE FROM incremental_state WHERE source_hash = %(query_hash)s OR target_hash = %(query_hash)s",
+                           {'query_hash': query_hash})
+
+        cursor.execute("SELECT to_regclass('public.tile_runs')")
+
+        if cursor.fetchone()[0] is not None:
+            for table in ['tile_links', 'tile_state']:
+                cursor.execute("""
+                DELETE FROM {}
+                WHERE run_key IN (SELECT run_key FROM tile_runs WHERE source_hash = %(query_hash)s OR target_hash = %(query_hash)s)""".format(table),
+                               {'query_hash': query_hash})
+
+            cursor.execute("DELETE FROM tile_runs WHERE source_hash = %(query_hash)s OR target_hash = %(query_hash)s", {'query_hash': query_hash})
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+MIN_CHUNKSIZE = 10
+MAX_BACKOFF = 60
+
+
+# Picks the chunk size for the next page of an endpoint. In adaptive mode the chunk size doubles as long as the time per
+# row improves by at least 10%, then falls back to the best size seen and stays there. Failures halve the chunk size.
+class ChunksizeController:
+    def __init__(self, chunksize, max_chunksize, adaptive=False, retries=3):
+        self.chunksize = chunksize
+        self.max_chunksize = max(chunksize, max_chunksize)
+        self.adaptive = adaptive
+        self.retries = retries
+        self.settled = not adaptive
+        self.best_chunksize = chunksize
+        self.best_rate = None
+        self.failures = 0
+
+    def limit(self, max_chunksize_server):
+        self.max_chunksize = min(self.max_chunksize, max_chunksize_server)
+        self.best_chunksize = min(self.best_chunksize, max_chunksize_server)
+        changed = self.chunksize > max_chunksize_server
+        self.chunksize = min(self.chunksize, max_chunksize_server)
+
+        return changed
+
+    def success(self, chunksize, size, elapsed):
+        # Returns True once the chunk size has settled
+        self.failures = 0
+
+        # Short pages (the end of the data or of the requested range) say nothing about the endpoint
+        if self.settled or size == 0 or size < chunksize or chunksize != self.chunksize:
+            return False
+
+        rate = elapsed / size
+
+        if self.best_rate is None or rate < self.best_rate * 0.9:
+            self.best_rate = rate
+            self.best_chunksize = self.chunksize
+
+            if self.chunksize < self.max_chunksize:
+                self.chunksize = min(self.chunksize * 2, self.max_chunksize)
+                return False
+        else:
+            self.chunksize = self.best_chunksize
+
+        self.settled = True
+        return True
+
+    def failure(self):
+        # Returns the seconds to wait before retrying, or None if the retries are used up
+        self.failures += 1
+
+        if self.failures > self.retries:
+            return None
+
+        if self.adaptive:
+            self.chunksize = max(MIN_CHUNKSIZE, self.chunksize // 2)
+            self.best_chunksize = min(self.best_chunksize, self.chunksize)
+            self.max_chunksize = self.chunksize
+            self.best_rate = None
+            self.settled = False
+
+        return min(2 ** (self.failures - 1), MAX_BACKOFF)
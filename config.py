@@ -3,6 +3,8 @@
 
 from json import loads
 
+import re
+
 
 class Config:
     def __init__(self, config, database_config):
@@ -10,6 +12,11 @@ class Config:
         self.database_config = database_config
         self.valid_relations = ['contains', 'contains_properly', 'covered_by', 'covers', 'crosses', 'disjoint', 'distance',
                                 'distance_within', 'equals', 'hausdorff_distance', 'intersects', 'overlaps', 'touches', 'within']
+        self.valid_multi_relations = ['contains', 'contains_properly', 'covered_by', 'covers', 'crosses', 'equals', 'intersects', 'overlaps',
+                                      'touches', 'within']
+        self.valid_backends = ['postgis', 'strtree']
+        self.valid_pagings = ['keyset', 'offset']
+        self.valid_end_detections = ['count', 'page', 'probe']
         self.check_config()
 
     def check_config(self):
@@ -47,6 +54,50 @@ class Config:
                 if not isinstance(self.config['source']['chunksize'], int):
                     raise ConfigNotValidError("Source chunksize is not an integer")
 
+            if 'adaptive_chunksize' in self.config['source']:
+                if not isinstance(self.config['source']['adaptive_chunksize'], bool):
+                    raise ConfigNotValidError("Source adaptive_chunksize is not a boolean")
+
+            if 'max_chunksize' in self.config['source']:
+                if not isinstance(self.config['source']['max_chunksize'], int):
+                    raise ConfigNotValidError("Source max_chunksize is not an integer")
+
+            if 'retries' in self.config['source']:
+                if not isinstance(self.config['source']['retries'], int) or self.config['source']['retries'] < 0:
+                    raise ConfigNotValidError("Source retries is not a non-negative integer")
+
+            if 'timeout' in self.config['source']:
+                if not isinstance(self.config['source']['timeout'], (int, float)) or self.config['source']['timeout'] <= 0:
+                    raise ConfigNotValidError("Source timeout is not a positive number")
+
+            if 'end_detection' in self.config['source']:
+                if self.config['source']['end_detection'] not in self.valid_end_detections:
+                    raise ConfigNotValidError("Source end_detection not valid. Only the following end detections are valid: {}".format(
+                        self.valid_end_detections))
+
+                if self.config['source']['end_detection'] == 'count' and 'rawquery' in self.config['source']:
+                    raise ConfigNotValidError("Source end_detection count is not supported for rawqueries")
+
+            if 'end_ttl' in self.config['source']:
+                if not isinstance(self.config['source']['end_ttl'], (int, float)) or self.config['source']['end_ttl'] < 0:
+                    raise ConfigNotValidError("Source end_ttl is not a non-negative number")
+
+            if 'workers' in self.config['source']:
+                if not isinstance(self.config['source']['workers'], int) or self.config['source']['workers'] < 1:
+                    raise ConfigNotValidError("Source workers is not a positive integer")
+
+            if 'subdivide' in self.config['source']:
+                if not isinstance(self.config['source']['subdivide'], int) or self.config['source']['subdivide'] < 5:
+                    raise ConfigNotValidError("Source subdivide must be an integer of at least 5")
+
+            if 'paging' in self.config['source']:
+                if self.config['source']['paging'] not in self.valid_pagings:
+                    raise ConfigNotValidError("Source paging not valid. Only the following pagings are valid: {}".format(self.valid_pagings))
+
+                if self.config['source']['paging'] == 'keyset' and 'rawquery' in self.config['source']:
+                    if re.search(r'\b(GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT|OFFSET)\b', self.config['source']['rawquery'], re.IGNORECASE):
+                        raise ConfigNotValidError("Source rawquery cannot be paged by keyset, it already groups, orders or limits its results")
+
         if 'target' not in self.config:
             raise ConfigNotValidError("Config is missing target")
         else:
@@ -81,18 +132,121 @@ class Config:
                 if not isinstance(self.config['target']['chunksize'], int):
                     raise ConfigNotValidError("Target chunksize is not an integer")
 
+            if 'adaptive_chunksize' in self.config['target']:
+                if not isinstance(self.config['target']['adaptive_chunksize'], bool):
+                    raise ConfigNotValidError("Target adaptive_chunksize is not a boolean")
+
+            if 'max_chunksize' in self.config['target']:
+                if not isinstance(self.config['target']['max_chunksize'], int):
+                    raise ConfigNotValidError("Target max_chunksize is not an integer")
+
+            if 'retries' in self.config['target']:
+                if not isinstance(self.config['target']['retries'], int) or self.config['target']['retries'] < 0:
+                    raise ConfigNotValidError("Target retries is not a non-negative integer")
+
+            if 'timeout' in self.config['target']:
+                if not isinstance(self.config['target']['timeout'], (int, float)) or self.config['target']['timeout'] <= 0:
+                    raise ConfigNotValidError("Target timeout is not a positive number")
+
+            if 'end_detection' in self.config['target']:
+                if self.config['target']['end_detection'] not in self.valid_end_detections:
+                    raise ConfigNotValidError("Target end_detection not valid. Only the following end detections are valid: {}".format(
+                        self.valid_end_detections))
+
+                if self.config['target']['end_detection'] == 'count' and 'rawquery' in self.config['target']:
+                    raise ConfigNotValidError("Target end_detection count is not supported for rawqueries")
+
+            if 'end_ttl' in self.config['target']:
+                if not isinstance(self.config['target']['end_ttl'], (int, float)) or self.config['target']['end_ttl'] < 0:
+                    raise ConfigNotValidError("Target end_ttl is not a non-negative number")
+
+            if 'workers' in self.config['target']:
+                if not isinstance(self.config['target']['workers'], int) or self.config['target']['workers'] < 1:
+                    raise ConfigNotValidError("Target workers is not a positive integer")
+
+            if 'subdivide' in self.config['target']:
+                if not isinstance(self.config['target']['subdivide'], int) or self.config['target']['subdivide'] < 5:
+                    raise ConfigNotValidError("Target subdivide must be an integer of at least 5")
+
+            if 'paging' in self.config['target']:
+                if self.config['target']['paging'] not in self.valid_pagings:
+                    raise ConfigNotValidError("Target paging not valid. Only the following pagings are valid: {}".format(self.valid_pagings))
+
+                if self.config['target']['paging'] == 'keyset' and 'rawquery' in self.config['target']:
+                    if re.search(r'\b(GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT|OFFSET)\b', self.config['target']['rawquery'], re.IGNORECASE):
+                        raise ConfigNotValidError("Target rawquery cannot be paged by keyset, it already groups, orders or limits its results")
+
         if 'measure' not in self.config:
             raise ConfigNotValidError("Measure not specified")
         else:
             if 'relation' not in self.config['measure']:
                 raise ConfigNotValidError("Relation not specified")
             else:
-                if self.config['measure']['relation'] not in self.valid_relations:
+                if isinstance(self.config['measure']['relation'], list):
+                    # Several topological relations are mapped together in one pass
+                    if len(self.config['measure']['relation']) == 0 or len(set(self.config['measure']['relation'])) != len(self.config['measure']['relation']):
+                        raise ConfigNotValidError("Relation list must not be empty or contain duplicates")
+
+                    for relation in self.config['measure']['relation']:
+                        if relation not in self.valid_multi_relations:
+                            raise ConfigNotValidError("Relation {} not valid in a relation list. Only the following relations are valid: {}".format(
+                                relation, self.valid_multi_relations))
+                elif self.config['measure']['relation'] not in self.valid_relations:
                     raise ConfigNotValidError("Relation not valid. Only the following relations are valid: {}".format(self.valid_relations))
                 elif self.config['measure']['relation'] == 'distance' or self.config['measure']['relation'] == 'distance_within' or self.config['measure']['relation'] == 'hausdorff_distance':
-                    if 'threshold' not in self.config['measure']:
+                    # The k nearest neighbours of every source geometry can be linked without a threshold
+                    if 'threshold' not in self.config['measure'] and ('k' not in self.config['measure'] or self.config['measure']['relation'] == 'distance_within'):
                         raise ConfigNotValidError("Config is missing measure threshold")
 
+                if 'k' in self.config['measure']:
+                    if self.config['measure']['relation'] != 'distance' and self.config['measure']['relation'] != 'hausdorff_distance':
+                        raise ConfigNotValidError("Measure k is only supported by distance and hausdorff_distance")
+
+                    if not isinstance(self.config['measure']['k'], int) or self.config['measure']['k'] < 1:
+                        raise ConfigNotValidError("Measure k is not a positive integer")
+
+            if 'workers' in self.config['measure']:
+                if not isinstance(self.config['measure']['workers'], int) or self.config['measure']['workers'] < 1:
+                    raise ConfigNotValidError("Measure workers is not a positive integer")
+
+            if 'compact' in self.config['measure']:
+                if not isinstance(self.config['measure']['compact'], bool):
+                    raise ConfigNotValidError("Measure compact must be a boolean")
+
+                if self.config['measure']['compact']:
+                    if self.config['measure']['relation'] != 'disjoint':
+                        raise ConfigNotValidError("Measure compact is only supported by disjoint")
+
+                    if str(self.config.get('output_format')).lower() in ['turtle', 'nt']:
+                        raise ConfigNotValidError("Measure compact is only supported by the csv and json output formats")
+
+                    if self.config.get('cache_results') or self.config.get('incremental'):
+                        raise ConfigNotValidError("Measure compact can not be combined with cache_results or incremental")
+
+            if 'backend' in self.config['measure']:
+                if self.config['measure']['backend'] not in self.valid_backends:
+                    raise ConfigNotValidError("Measure backend not valid. Only the following backends are valid: {}".format(self.valid_backends))
+
+            if 'tile_rows' in self.config['measure']:
+                if not isinstance(self.config['measure']['tile_rows'], int) or self.config['measure']['tile_rows'] < 1:
+                    raise ConfigNotValidError("Measure tile_rows is not a positive integer")
+
+                # Tiles only hold the pairs near them, k nearest neighbours and disjoint pairs need all of them
+                if 'k' in self.config['measure'] or self.config['measure']['relation'] == 'disjoint':
+                    raise ConfigNotValidError("Measure tile_rows is not supported by k nearest mappings and disjoint")
+
+                if self.config['measure'].get('backend') == 'strtree' or self.config.get('incremental'):
+                    raise ConfigNotValidError("Measure tile_rows can not be combined with the strtree backend or incremental")
+
+        if 'cache_results' in self.config and not isinstance(self.config['cache_results'], bool):
+            raise ConfigNotValidError("Cache results must be a boolean")
+
+        if 'incremental' in self.config and not isinstance(self.config['incremental'], bool):
+            raise ConfigNotValidError("Incremental must be a boolean")
+
+        if 'explain' in self.config and not isinstance(self.config['explain'], bool):
+            raise ConfigNotValidError("Explain must be a boolean")
+
         # Check database config
         if 'database_name' not in self.database_config:
             raise ConfigNotValidError("Database name not specified")
@@ -103,6 +257,27 @@ class Config:
         if 'database_password' not in self.database_config:
             raise ConfigNotValidError("Database password not specified")
 
+    def get_adaptive_chunksize(self, type):
+        if type != 'source' and type != 'target':
+            raise Exception("Wrong type (not source or target) specified")
+
+        if 'adaptive_chunksize' in self.config[type]:
+            return self.config[type]['adaptive_chunksize']
+        else:
+            return False
+
+    def get_backend(self):
+        if 'backend' in self.config['measure']:
+            return self.config['measure']['backend']
+        else:
+            return 'postgis'
+
+    def get_cache_results(self):
+        if 'cache_results' in self.config:
+            return self.config['cache_results']
+        else:
+            return False
+
     def get_chunksize(self, type):
         if type != 'source' and type != 'target':
             raise Exception("Wrong type (not source or target) specified")
@@ -112,6 +287,12 @@ class Config:
         else:
             return 1000
 
+    def get_compact(self):
+        if 'compact' in self.config['measure']:
+            return self.config['measure']['compact']
+        else:
+            return False
+
     def get_database_name(self):
         return self.database_config['database_name']
 
@@ -134,9 +315,25 @@ class Config:
             return '5432'
 
     def get_database_string(self):
-        return "host='{}' dbname='{}' user='{}' password='{}' port={}".format(self.get_database_host(), self.get_database_name(),
-                                                                              self.get_database_user(), self.get_database_password(),
-                                                                              self.get_database_port())
+        return get_database_string(self.database_config)
+
+    def get_end_detection(self, type):
+        if type != 'source' and type != 'target':
+            raise Exception("Wrong type (not source or target) specified")
+
+        if 'end_detection' in self.config[type]:
+            return self.config[type]['end_detection']
+        else:
+            return 'page'
+
+    def get_end_ttl(self, type):
+        if type != 'source' and type != 'target':
+            raise Exception("Wrong type (not source or target) specified")
+
+        if 'end_ttl' in self.config[type]:
+            return self.config[type]['end_ttl']
+        else:
+            return 0
 
     def get_endpoint(self, type):
         if type != 'source' and type != 'target':
@@ -144,6 +341,12 @@ class Config:
 
         return self.config[type]['endpoint']
 
+    def get_explain(self):
+        if 'explain' in self.config:
+            return self.config['explain']
+        else:
+            return False
+
     def get_geo_coding(self, type):
         if type != 'source' and type != 'target':
             raise Exception("Wrong type (not source or target) specified")
@@ -165,6 +368,18 @@ class Config:
 
         return self.config[type]['graph']
 
+    def get_incremental(self):
+        if 'incremental' in self.config:
+            return self.config['incremental']
+        else:
+            return False
+
+    def get_k(self):
+        if 'k' in self.config['measure']:
+            return self.config['measure']['k']
+        else:
+            return None
+
     def get_limit(self, type):
         if type != 'source' and type != 'target':
             raise Exception("Wrong type (not source or target) specified")
@@ -174,9 +389,30 @@ class Config:
         else:
             return -1
 
+    def get_max_chunksize(self, type):
+        if type != 'source' and type != 'target':
+            raise Exception("Wrong type (not source or target) specified")
+
+        if 'max_chunksize' in self.config[type]:
+            return self.config[type]['max_chunksize']
+        else:
+            return self.get_chunksize(type) * 16
+
+    def get_measure_workers(self):
+        if 'workers' in self.config['measure']:
+            return self.config['measure']['workers']
+        else:
+            return 1
+
     def get_relation(self):
         return self.config['measure']['relation']
 
+    def get_relations(self):
+        if isinstance(self.config['measure']['relation'], list):
+            return self.config['measure']['relation']
+        else:
+            return [self.config['measure']['relation']]
+
     def get_offset(self, type):
         if type != 'source' and type != 'target':
             raise Exception("Wrong type (not source or target) specified")
@@ -192,6 +428,15 @@ class Config:
         else:
             return None
 
+    def get_paging(self, type):
+        if type != 'source' and type != 'target':
+            raise Exception("Wrong type (not source or target) specified")
+
+        if 'paging' in self.config[type]:
+            return self.config[type]['paging']
+        else:
+            return 'offset'
+
     def get_prefixes(self):
         if 'prefixes' in self.config:
             return self.config['prefixes']
@@ -213,6 +458,15 @@ class Config:
         else:
             return None
 
+    def get_retries(self, type):
+        if type != 'source' and type != 'target':
+            raise Exception("Wrong type (not source or target) specified")
+
+        if 'retries' in self.config[type]:
+            return self.config[type]['retries']
+        else:
+            return 3
+
     def get_restriction(self, type):
         if type != 'source' and type != 'target':
             raise Exception("Wrong type (not source or target) specified")
@@ -222,8 +476,35 @@ class Config:
         else:
             return None
 
+    def get_subdivide(self, type):
+        if type != 'source' and type != 'target':
+            raise Exception("Wrong type (not source or target) specified")
+
+        if 'subdivide' in self.config[type]:
+            return self.config[type]['subdivide']
+        else:
+            return None
+
     def get_threshold(self):
-        return self.config['measure']['threshold']
+        if 'threshold' in self.config['measure']:
+            return self.config['measure']['threshold']
+        else:
+            return None
+
+    def get_tile_rows(self):
+        if 'tile_rows' in self.config['measure']:
+            return self.config['measure']['tile_rows']
+        else:
+            return None
+
+    def get_timeout(self, type):
+        if type != 'source' and type != 'target':
+            raise Exception("Wrong type (not source or target) specified")
+
+        if 'timeout' in self.config[type]:
+            return self.config[type]['timeout']
+        else:
+            return None
 
     def get_var_uri(self, type):
         if type != 'source' and type != 'target':
@@ -237,6 +518,15 @@ class Config:
 
         return self.config[type]['var']['shape']
 
+    def get_workers(self, type):
+        if type != 'source' and type != 'target':
+            raise Exception("Wrong type (not source or target) specified")
+
+        if 'workers' in self.config[type]:
+            return self.config[type]['workers']
+        else:
+            return 1
+
     def get_endpoint_type(self, type):
         if self.config[type]['endpoint'].startswith('http'):
             return 'remote' #0
@@ -252,6 +542,14 @@ class ConfigNotValidError(Exception):
         return(self.error)
 
 
+def get_database_string(database_config):
+    return "host='{}' dbname='{}' user='{}' password='{}' port={}".format(database_config.get('database_host', 'localhost'),
+                                                                          database_config['database_name'],
+                                                                          database_config['database_user'],
+                                                                          database_config['database_password'],
+                                                                          database_config.get('database_port', 5432))
+
+
 def load_config(config_file_path):
     with open(config_file_path, 'r') as config_file:
         return loads(config_file.read())
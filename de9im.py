@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# DE-9IM patterns of the topological relations. A relation holds if the intersection matrix of a pair matches one of its
+# patterns whose dimension condition is met. The conditions compare the dimensions of the source ({a}) and target ({b}).
+PATTERNS = {
+    'contains': [('T*****FF*', None)],
+    'contains_properly': [('T**FF*FF*', None)],
+    'covered_by': [('T*F**F***', None), ('*TF**F***', None), ('**FT*F***', None), ('**F*TF***', None)],
+    'covers': [('T*****FF*', None), ('*T****FF*', None), ('***T**FF*', None), ('****T*FF*', None)],
+    'crosses': [('T*T******', '{a} < {b}'), ('T*****T**', '{a} > {b}'), ('0********', '{a} = 1 AND {b} = 1')],
+    'disjoint': [('FF*FF****', None)],
+    'equals': [('T*F**FFF*', None)],
+    'intersects': [('T********', None), ('*T*******', None), ('***T*****', None), ('****T****', None)],
+    'overlaps': [('T*T***T**', '{a} = {b} AND {a} <> 1'), ('1*T***T**', '{a} = 1 AND {b} = 1')],
+    'touches': [('FT*******', None), ('F**T*****', None), ('F***T****', None)],
+    'within': [('T*F**F***', None)]
+}
+
+
+def build_condition(relation, matrix, source_dimension, target_dimension):
+    # Returns the SQL condition for the relation on the given matrix and dimension columns
+    conditions = []
+
+    for pattern, dimensions in PATTERNS[relation]:
+        condition = "ST_RelateMatch({}, '{}')".format(matrix, pattern)
+
+        if dimensions is not None:
+            dimensions = dimensions.format(a=source_dimension, b=target_dimension)
+            condition = '({} AND {})'.format(dimensions, condition)
+
+        conditions.append(condition)
+
+    return '({})'.format(' OR '.join(conditions))
@@ -2,15 +2,20 @@
 # -*- coding: utf-8 -*-
 
 from json import JSONDecodeError, loads
+from logging import INFO
 from os import makedirs
 from os.path import exists, isdir
 from urllib.error import HTTPError
 
 from cache import Cache
+from catalog import CacheCatalog
 from config import Config, ConfigNotValidError, load_config
 from logger import InfoLogger
 from mapper import Mapper
 from sparql import SPARQL
+from tracer import Tracer
+
+import psycopg2
 
 
 class goeLIMES:
@@ -20,6 +25,7 @@ class goeLIMES:
     def run(self, config_json, to_file=True):
         self.create_dirs()
         results = None
+        tracer = None
 
         try:
             config = Config(config_json, self.database_config)
@@ -28,21 +34,13 @@ class goeLIMES:
             target_sparql = SPARQL(config, 'target')
 
             info_logger = InfoLogger('InfoLogger', '{}_{}'.format(source_sparql.get_query_hash(), target_sparql.get_query_hash()))
+            tracer = Tracer('{}_{}'.format(source_sparql.get_query_hash(), target_sparql.get_query_hash()))
 
-            source_cache = Cache(info_logger,  config, source_sparql, 'source')
-            if config.get_endpoint_type('source') == 'remote': #0:
-                source_cache.create_cache()
-            elif config.get_endpoint_type('source') == 'local': #1:
-                source_cache.create_cache_file()
-
-            target_cache = Cache(info_logger, config, target_sparql, 'target')
-            if config.get_endpoint_type('target') == 'remote': #0:
-                target_cache.create_cache()
-            elif config.get_endpoint_type('target') == 'local': #1:
-                target_cache.create_cache_file()
+            self.create_caches(config, info_logger, source_sparql, target_sparql, tracer)
 
-            mapper = Mapper(info_logger, config, source_sparql, target_sparql)
+            mapper = Mapper(info_logger, config, source_sparql, target_sparql, tracer)
             results = mapper.map(to_file)
+            self.apply_eviction_policy(info_logger, [source_sparql.get_query_hash(), target_sparql.get_query_hash()])
         except ConfigNotValidError as e:
             results = "Config not valid"
             print(e)
@@ -50,12 +48,88 @@ class goeLIMES:
             print(e)
         except JSONDecodeError as e:
             print(e)
+        finally:
+            # Failed runs are traced as well, up to the stage that failed
+            if tracer is not None:
+                tracer.write()
 
         return results
 
+    def create_caches(self, config, info_logger, source_sparql, target_sparql, tracer=None):
+        for type, sparql in [('source', source_sparql), ('target', target_sparql)]:
+            cache = Cache(info_logger, config, sparql, type, tracer)
+
+            if config.get_endpoint_type(type) == 'remote': #0:
+                cache.create_cache()
+            elif config.get_endpoint_type(type) == 'local': #1:
+                cache.create_cache_file()
+
+    def warm(self, config_json):
+        # Fills the source and target caches of a config without mapping
+        self.create_dirs()
+
+        try:
+            config = Config(config_json, self.database_config)
+            source_sparql = SPARQL(config, 'source')
+            target_sparql = SPARQL(config, 'target')
+            info_logger = InfoLogger('InfoLogger', '{}_{}'.format(source_sparql.get_query_hash(), target_sparql.get_query_hash()))
+            tracer = Tracer('{}_{}'.format(source_sparql.get_query_hash(), target_sparql.get_query_hash()))
+            self.create_caches(config, info_logger, source_sparql, target_sparql, tracer)
+            tracer.write()
+            self.apply_eviction_policy(info_logger, [source_sparql.get_query_hash(), target_sparql.get_query_hash()])
+
+            return [source_sparql.get_query_hash(), target_sparql.get_query_hash()]
+        except ConfigNotValidError as e:
+            print(e)
+        except HTTPError as e:
+            print(e)
+
+        return None
+
+    def list_caches(self):
+        return CacheCatalog(self.database_config).list_caches()
+
+    def evict(self, query_hashes=None):
+        return CacheCatalog(self.database_config).evict(query_hashes)
+
+    def apply_eviction_policy(self, info_logger, keep):
+        catalog = CacheCatalog(self.database_config)
+
+        if catalog.get_cache_budget() is None and catalog.get_cache_ttl() is None:
+            return
+
+        evicted = catalog.evict(keep=keep)
+
+        if len(evicted) > 0:
+            info_logger.logger.log(INFO, "Evicted caches: {}".format(', '.join(evicted)))
+
+    def reindex(self, config_json):
+        self.create_dirs()
+
+        try:
+            config = Config(config_json, self.database_config)
+            source_sparql = SPARQL(config, 'source')
+            target_sparql = SPARQL(config, 'target')
+            info_logger = InfoLogger('InfoLogger', '{}_{}'.format(source_sparql.get_query_hash(), target_sparql.get_query_hash()))
+
+            for type, sparql in [('source', source_sparql), ('target', target_sparql)]:
+                cache = Cache(info_logger, config, sparql, type)
+                connection = psycopg2.connect(config.get_database_string())
+                cache.create_table(connection)
+                valid = cache.validate_index(connection)
+                duplicates = cache.rebuild_index(connection)
+                connection.close()
+                info_logger.logger.log(INFO, "Rebuilt index of {} cache (was valid: {}), removed {} duplicate rows".format(
+                    type, valid, duplicates))
+        except ConfigNotValidError as e:
+            print(e)
+
     def create_dirs(self):
         if not exists('logs') or not isdir('logs'):
             makedirs('logs')
 
         if not exists('output') or not isdir('output'):
             makedirs('output')
+
+        if not exists('store') or not isdir('store'):
+            makedirs('store')
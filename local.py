@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from glob import glob
+from gzip import open as gzip_open
+from hashlib import md5
+from os import getpid, remove, rename, stat
+from os.path import abspath, exists, join
+from rdflib import Graph, URIRef
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser
+from rdflib.util import guess_format
+from threading import Lock
+from urllib.parse import unquote, urlsplit
+
+import csv
+import re
+
+# Parsed graphs of the files used by this process, keyed by path, mtime and size
+graphs = {}
+graphs_lock = Lock()
+
+
+# SPARQL engine for file:// endpoints. Every result is kept under store/, keyed by the file's path, mtime and size and by
+# the query, so later runs read it back instead of parsing the file again. Results of earlier versions of the file are
+# removed when a result of its current version is stored. Within one process a file is parsed at most once. Simple property configs on N-Triples files skip rdflib's graph and SPARQL evaluation altogether.
+class LocalEndpoint:
+    def __init__(self, config, type):
+        self.config = config
+        self.type = type
+        self.path = unquote(urlsplit(config.get_endpoint(type)).path)
+        self.format = guess_format(self.path) or 'nt'
+
+    def get_file_key(self):
+        file_stat = stat(self.path)
+        return '{}#{}#{}'.format(abspath(self.path), file_stat.st_mtime_ns, file_stat.st_size)
+
+    def get_result_prefix(self, file_key):
+        # Results are named <path digest>_<file version digest>_<query digest>, so those of a path are found by prefix
+        path, mtime, size = file_key.rsplit('#', 2)
+        return join('store', '{}_{}'.format(md5(path.encode('utf-8')).hexdigest(), md5('{}#{}'.format(mtime, size).encode('utf-8')).hexdigest()))
+
+    def query(self, query):
+        file_key = self.get_file_key()
+        result_prefix = self.get_result_prefix(file_key)
+        result_path = '{}_{}.csv.gz'.format(result_prefix, md5(query.encode('utf-8')).hexdigest())
+
+        if not exists(result_path):
+            temp_path = '{}.{}.tmp'.format(result_path, getpid())
+
+            try:
+                with gzip_open(temp_path, 'wt', encoding='utf-8', newline='') as result_file:
+                    predicate = self.get_simple_predicate()
+
+                    if predicate is not None and self.format == 'nt':
+                        self.stream_triples(predicate, result_file)
+                    else:
+                        result_file.write(self.get_graph(file_key).query(query).serialize(format='csv').decode('utf-8'))
+
+                rename(temp_path, result_path)
+            finally:
+                if exists(temp_path):
+                    remove(temp_path)
+
+            self.remove_outdated_results(result_prefix)
+
+        return gzip_open(result_path, 'rt', encoding='utf-8', newline='')
+
+    def remove_outdated_results(self, result_prefix):
+        path_prefix = result_prefix[:result_prefix.rindex('_')]
+
+        for path in glob(path_prefix + '_*.csv.gz'):
+            if not path.startswith(result_prefix + '_'):
+                try:
+                    remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def get_graph(self, file_key):
+        with graphs_lock:
+            if file_key not in graphs:
+                graph = Graph()
+                graph.parse(self.path, format=self.format)
+                graphs[file_key] = graph
+
+            return graphs[file_key]
+
+    def get_simple_predicate(self):
+        # Returns the predicate IRI of a config whose only pattern is "?uri <predicate> ?shape", None otherwise
+        if self.config.get_rawquery(self.type) is not None or self.config.get_restriction(self.type) is not None:
+            return None
+
+        match = re.fullmatch(r'\s*\?{}\s+(\S+)\s+\?{}\s*\.?\s*'.format(re.escape(self.config.get_var_uri(self.type)),
+                                                                       re.escape(self.config.get_var_shape(self.type))),
+                             self.config.get_property(self.type))
+
+        if match is None:
+            return None
+
+        predicate = match.group(1)
+
+        if predicate.startswith('<') and predicate.endswith('>'):
+            return URIRef(predicate[1:-1])
+
+        for prefix in self.config.get_prefixes() or []:
+            if predicate.startswith(prefix['label'] + ':'):
+                return URIRef(prefix['namespace'] + predicate[len(prefix['label']) + 1:])
+
+        return None
+
+    def stream_triples(self, predicate, result_file):
+        writer = csv.writer(result_file, lineterminator='\r\n')
+        writer.writerow([self.config.get_var_uri(self.type), self.config.get_var_shape(self.type)])
+
+        with open(self.path, 'rb') as triples:
+            W3CNTriplesParser(TripleSink(predicate, writer)).parse(triples)
+
+
+# Receives the triples of the N-Triples parser and writes the subject/object pairs of one predicate. Duplicate triples
+# are written as they come, without keeping state per pair, the staged insert of the cache stores every geometry once.
+class TripleSink:
+    def __init__(self, predicate, writer):
+        self.predicate = predicate
+        self.writer = writer
+
+    def triple(self, subject, predicate, object):
+        if predicate != self.predicate:
+            return
+
+        self.writer.writerow([str(subject), str(object)])
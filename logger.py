@@ -20,18 +20,6 @@ class ErrorLogger:
         self.logger.addHandler(logger_handler)
 
 
-class ResultLogger:
-    def __init__(self, name, source_hash, source_offset, source_limit, relation,target_hash,target_offset, target_limit):
-        self.logger = logging.getLogger('{}#{}#{}_{}_{}#{}#{}_{}'.format(source_hash, source_offset, source_limit, relation, target_hash, target_offset, target_limit, name))
-        self.logger.setLevel(logging.INFO)
-        self.logger.propagate = False
-
-        logger_handler = logging.FileHandler(join('output', '{}#{}#{}_{}_{}#{}#{}.log'.format(source_hash, source_offset, source_limit, relation, target_hash, target_offset, target_limit)), mode='w')
-        logger_handler.setLevel(logging.INFO)
-        logger_formater = logging.Formatter('%(message)s')
-        logger_handler.setFormatter(logger_formater)
-        self.logger.addHandler(logger_handler)
-
 class InfoLogger:
     def __init__(self, name, query_hash):
         self.logger = logging.getLogger('{}_{}_{}'.format(name, query_hash, time()))
@@ -49,6 +37,11 @@ class InfoLogger:
         self.logger.addHandler(logger_handler)
 
 
+def get_result_path(source_hash, source_offset, source_limit, relation, target_hash, target_offset, target_limit):
+    return join('output', '{}#{}#{}_{}_{}#{}#{}.log'.format(source_hash, source_offset, source_limit, relation, target_hash, target_offset,
+                                                            target_limit))
+
+
 def load_logfile(query_hash, error_type):
     try:
         with open(join('logs', '{}_{}.log'.format(query_hash, error_type))) as logfile:
@@ -4,7 +4,7 @@
 from argparse import ArgumentParser
 from sys import path
 
-from config import load_config
+from config import ConfigNotValidError, load_config
 from geolimes import goeLIMES
 
 path.append("${HOME}/.local/lib/python3.7/site-packages/")
@@ -12,22 +12,48 @@ path.append("${HOME}/.local/lib/python3.7/site-packages/")
 
 def get_arguments():
     parser = ArgumentParser(description="Python LIMES")
-    parser.add_argument("-c", "--config", type=str, dest="config_file", help="Path to a config file", required=True)
+    parser.add_argument("-c", "--config", type=str, dest="config_file", help="Path to a config file")
     parser.add_argument("-d", "--database", type=str, dest="database_config_file", help="Path to a database config file", required=True)
+    parser.add_argument("-r", "--reindex", action="store_true", dest="reindex",
+                        help="Remove duplicate rows from the source and target caches and rebuild their unique indexes")
+    parser.add_argument("-w", "--warm", action="store_true", dest="warm", help="Fill the source and target caches without mapping")
+    parser.add_argument("-l", "--list-caches", action="store_true", dest="list_caches", help="List the caches in the database")
+    parser.add_argument("-e", "--evict", type=str, nargs='*', dest="evict", metavar="QUERY_HASH",
+                        help="Evict the given caches, or the caches selected by the eviction policy if none are given")
     parser.add_argument("-v", "--version", action="version", version="0.0.1", help="Show program version and exit")
     arguments = parser.parse_args()
-    return arguments.config_file, arguments.database_config_file
+
+    if arguments.config_file is None and not arguments.list_caches and arguments.evict is None:
+        parser.error("the following arguments are required: -c/--config")
+
+    return arguments
 
 
 def main():
     try:
-        connfig_file_path, database_config_file_path = get_arguments()
-        config = load_config(connfig_file_path)
-        database_config = load_config(database_config_file_path)
+        arguments = get_arguments()
+        database_config = load_config(arguments.database_config_file)
         limes = goeLIMES(database_config)
-        limes.run(config)
+
+        if arguments.list_caches:
+            for cache in limes.list_caches():
+                print("{query_hash}  {endpoint}  {rows} rows  {size} bytes  created {created_at}  last hit {last_hit}".format(**cache))
+        elif arguments.evict is not None:
+            for query_hash in limes.evict(arguments.evict or None):
+                print("Evicted {}".format(query_hash))
+        else:
+            config = load_config(arguments.config_file)
+
+            if arguments.reindex:
+                limes.reindex(config)
+            elif arguments.warm:
+                limes.warm(config)
+            else:
+                limes.run(config)
     except FileNotFoundError as e:
         print(e)
+    except ConfigNotValidError as e:
+        print(e)
 
 
 if __name__ == "__main__":
@@ -1,31 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from logger import InfoLogger, ResultLogger
+from concurrent.futures import ThreadPoolExecutor
+from config import ConfigNotValidError
+from de9im import build_condition
+from hashlib import md5
+from io import StringIO
+from logger import InfoLogger, get_result_path
+from results import IncrementalLinks, ResultCache, TileCheckpoint
 from logging import INFO
-from pandas import DataFrame
+from queue import Empty, Full, Queue
+from strtree import is_available, map_geometries
+from threading import Event, Thread
+from tiles import MAX_DEPTH, build_quadtree
+from tracer import Tracer
 
 import csv
+import json
 import psycopg2
 import time
 
+# Rows fetched from the server-side cursor at once
+BATCH_SIZE = 10000
+# Seconds a partition waits for room in the queue before it checks whether it was stopped
+QUEUE_TIMEOUT = 0.1
+
+# Relations that hold for two geometries if they hold for any pair of their pieces
+PIECE_RELATIONS = ['distance_within', 'intersects']
+# Relations that imply intersection, subdivided pieces find their candidate pairs
+CANDIDATE_RELATIONS = ['contains', 'contains_properly', 'covered_by', 'covers', 'crosses', 'overlaps', 'touches', 'within']
+
 
 class Mapper:
-    def __init__(self, logger, config, source_sparql, target_sparql):
+    def __init__(self, logger, config, source_sparql, target_sparql, tracer=None):
         self.config = config
+        self.tracer = tracer if tracer is not None else Tracer()
         self.source_sparql = source_sparql
         self.target_sparql = target_sparql
-        self.relation = config.get_relation()
+        self.relations = config.get_relations()
+        self.relation = '+'.join(self.relations)
 
         self.info_logger = logger
-        #self.result_logger = ResultLogger('ResultLogger', source_sparql.get_query_hash(), target_sparql.get_query_hash())
 
         source_offset = self.config.get_offset('source')
         source_limit = self.config.get_limit('source')
         target_offset = self.config.get_offset('target')
         target_limit = self.config.get_limit('target')
-        self.result_logger = ResultLogger('ResultLogger', source_sparql.get_query_hash(), source_offset, source_limit, self.relation, target_sparql.get_query_hash(),target_offset, target_limit)
-
+        self.result_path = get_result_path(source_sparql.get_query_hash(), source_offset, source_limit, self.relation,
+                                           target_sparql.get_query_hash(), target_offset, target_limit)
 
     def map(self, to_file=True):
         self.info_logger.logger.log(INFO, "Mapping started...")
@@ -85,71 +107,707 @@ class Mapper:
         elif self.relation == 'hausdorff_distance':
             relation_function = 'ST_HAUSDORFFDISTANCE'
 
-        if self.relation == 'distance' or self.relation == 'hausdorff_distance':
-            query = """
-            set parallel_setup_cost = 10;
-            set parallel_tuple_cost = 0.001;
-            SELECT {}(source_data.geo, target_data.geo) AS distance, source_data.\"{}\" AS source_uri, target_data.\"{}\" AS target_uri
-            FROM ({}) AS source_data, ({}) AS target_data
-            """.format(relation_function, self.config.get_var_uri('source'), self.config.get_var_uri('target'), source_query, target_query)
+        result_cache = None
+
+        if self.config.get_cache_results() and not self.config.get_incremental():
+            result_cache = ResultCache(self.config, source_query_hash, target_query_hash)
+
+        if self.config.get_incremental():
+            batches = self.map_incremental(source_query, target_query, relation_function)
+        elif result_cache is not None and result_cache.find() is not None:
+            self.info_logger.logger.log(INFO, "Caches unchanged, using stored mapping results")
+            batches = result_cache.iterate_links()
         else:
+            batches = self.compute_links(source_query, target_query, relation_function)
+
+            # Results can only be reused if both caches have a version to compare against
+            if result_cache is not None and result_cache.source_version is not None and result_cache.target_version is not None:
+                batches = result_cache.store(batches)
+
+        batches = self.tracer.iterate('format', batches, output_format=self.config.get_output_format())
+
+        # Batches are written as they arrive, only the server, which returns the results, keeps them in memory
+        if to_file:
+            with open(self.result_path, 'w') as output:
+                count = self.write_results(batches, output)
+                output_bytes = output.tell()
+
+            formatted_results = None
+        else:
+            output = StringIO()
+            count = self.write_results(batches, output)
+            formatted_results = output.getvalue()
+            output_bytes = len(formatted_results.encode('utf-8'))
+
+        end = time.time()
+        self.tracer.add('map', start, end - start, relation=self.relation, backend=self.config.get_backend(), rows=count, bytes=output_bytes)
+
+        self.info_logger.logger.log(INFO, "Mapping took: {}s".format(round(end - start, 4)))
+        self.info_logger.logger.log(INFO, "{} mappings found".format(count))
+
+        return formatted_results
+
+    def map_incremental(self, source_query, target_query, relation_function):
+        # Joins only the members added to either cache since the last run, (new source x all target) and (old source x
+        # new target), stores the links by geometry id and returns all stored links of the configured ranges
+        incremental_links = IncrementalLinks(self.config, self.source_sparql.get_query_hash(), self.target_sparql.get_query_hash())
+
+        try:
+            recorded, current = incremental_links.begin()
+
+            # New targets can push old ones out of the k nearest, so k nearest mappings are always computed in full
+            if recorded is None or self.config.get_k() is not None:
+                self.info_logger.logger.log(INFO, "Mapping all rows")
+                incremental_links.clear()
+                joins = [(self.build_id_query('source', source_query, 'COALESCE(batch, 0) <= {}'.format(current[0] or 0)),
+                          self.build_id_query('target', target_query, 'COALESCE(batch, 0) <= {}'.format(current[1] or 0)))]
+            else:
+                joins = []
+
+                if current[0] != recorded[0]:
+                    joins.append((self.build_id_query('source', source_query, 'batch > {} AND batch <= {}'.format(recorded[0], current[0])),
+                                  self.build_id_query('target', target_query, 'COALESCE(batch, 0) <= {}'.format(current[1]))))
+
+                if current[1] != recorded[1]:
+                    joins.append((self.build_id_query('source', source_query, 'COALESCE(batch, 0) <= {}'.format(recorded[0])),
+                                  self.build_id_query('target', target_query, 'batch > {} AND batch <= {}'.format(recorded[1], current[1]))))
+
+                self.info_logger.logger.log(INFO, "Mapping rows added since the last run ({} joins)".format(len(joins)))
+
+            for join_source_query, join_target_query in joins:
+                count = incremental_links.add(self.compute_links(join_source_query, join_target_query, relation_function))
+                self.info_logger.logger.log(INFO, "{} new links".format(count))
+
+            incremental_links.commit(current)
+        except Exception:
+            incremental_links.rollback()
+            raise
+
+        return incremental_links.iterate_links(source_query, target_query,
+                                               self.relation != 'distance' and self.relation != 'hausdorff_distance')
+
+    def compute_links(self, source_query, target_query, relation_function):
+        # Returns the link batches of the join, computed by the configured backend
+        if self.config.get_backend() == 'strtree':
+            return self.map_strtree(source_query, target_query)
+
+        if self.config.get_tile_rows() is not None:
+            return self.map_tiles(source_query, target_query, relation_function)
+
+        # Compact rows need all geometries of a source uri, which partitions by server_offset can split
+        if self.config.get_measure_workers() > 1 and not self.config.get_compact():
+            batches = self.map_partitions(source_query, target_query, relation_function, self.config.get_measure_workers())
+        else:
+            batches = self.iterate_query(self.build_query(source_query, target_query, relation_function))
+
+        return (self.get_links(rows) for rows in batches)
+
+    def map_strtree(self, source_query, target_query):
+        # Reads the geometries of both sides and maps them in process with Shapely, on a pool of measure workers
+        if not is_available():
+            raise ConfigNotValidError("Backend strtree requires shapely 2")
+
+        threshold = self.config.get_threshold()
+
+        return map_geometries(self.read_geometries('source', source_query), self.read_geometries('target', target_query),
+                              self.relations, float(threshold) if threshold is not None else None, self.config.get_k(),
+                              self.config.get_measure_workers(), self.config.get_compact())
+
+    def read_geometries(self, type, query):
+        connection = psycopg2.connect(self.config.get_database_string())
+        cursor = connection.cursor()
+
+        with self.tracer.span('fetch', type=type, backend='strtree') as span:
+            cursor.execute('SELECT data."{}", ST_AsBinary(data.geo) FROM ({}) AS data'.format(self.config.get_var_uri(type), query))
+            geometries = [(uri, bytes(wkb)) for uri, wkb in cursor.fetchall()]
+            span['rows'] = len(geometries)
+            span['bytes'] = sum(len(wkb) for _, wkb in geometries)
+
+        cursor.close()
+        connection.close()
+
+        return geometries
+
+    def build_id_query(self, type, query, condition):
+        # Rows of a side with the geometry id in place of the uri, so the mapping queries link geometries
+        return """
+            SELECT server_offset, geometry_id, geometry_id AS \"{}\", geo, geo_status, bbox, area, npoints, geometry_type, batch
+            FROM ({}) AS data
+            WHERE {}""".format(self.config.get_var_uri(type), query, condition)
+
+    def build_query(self, source_query, target_query, relation_function, tile_condition=''):
+        # A tile condition is added to the join condition of the pairs
+        if len(self.relations) > 1:
+            return self.build_multi_query(source_query, target_query, tile_condition)
+        elif self.relation == 'distance' or self.relation == 'hausdorff_distance':
+            if self.config.get_k() is not None:
+                return self.build_nearest_query(source_query, target_query, relation_function)
+
+            # The Hausdorff distance is never smaller than the distance, so ST_DWithin prunes both with the GIST index
             query = """
-            set parallel_setup_cost = 10;
-            set parallel_tuple_cost = 0.001;
+            SELECT {0}(source_data.geo, target_data.geo) AS distance, source_data.\"{1}\" AS source_uri, target_data.\"{2}\" AS target_uri
+            FROM ({3}) AS source_data
+            INNER JOIN
+            ({4}) AS target_data
+            ON ST_DWITHIN(source_data.geo, target_data.geo, {5}){6}
+            """
+
+            if self.relation == 'hausdorff_distance':
+                query += "WHERE {0}(source_data.geo, target_data.geo) <= {5}"
+
+            return query.format(relation_function, self.config.get_var_uri('source'), self.config.get_var_uri('target'), source_query, target_query,
+                       float(self.config.get_threshold()), tile_condition)
+        elif self.relation == 'disjoint':
+            if self.config.get_compact():
+                return self.build_compact_disjoint_query(source_query, target_query)
+
+            return self.build_disjoint_query(source_query, target_query)
+        elif self.relation in PIECE_RELATIONS + CANDIDATE_RELATIONS and (self.config.get_subdivide('source') is not None or
+                                                                          self.config.get_subdivide('target') is not None):
+            return self.build_pieces_query(source_query, target_query, relation_function, tile_condition)
+        else:
+            return """
             SELECT DISTINCT source_data.\"{}\" AS source_uri, target_data.\"{}\" AS target_uri
             FROM ({}) AS source_data
             INNER JOIN
             ({}) AS target_data
-            ON {}(source_data.geo, target_data.geo)
-            """.format(self.config.get_var_uri('source'), self.config.get_var_uri('target'), source_query, target_query, relation_function)
-        print("DEBUG: Query",query)
+            ON {}{}{}
+            """.format(self.config.get_var_uri('source'), self.config.get_var_uri('target'), source_query, target_query,
+                       self.get_prefilter(), self.get_condition(relation_function, 'source_data.geo', 'target_data.geo'), tile_condition)
+
+    def build_multi_query(self, source_query, target_query, tile_condition=''):
+        # Computes the DE-9IM matrix of every intersecting pair once and derives all requested relations from it
+        relations = ', '.join("('{}', {})".format(relation, build_condition(relation, 'pairs.matrix', 'pairs.source_dimension',
+                                                                             'pairs.target_dimension'))
+                              for relation in self.relations)
+
+        return """
+            SELECT DISTINCT pairs.source_uri, relations.relation, pairs.target_uri
+            FROM (
+                SELECT source_data.\"{}\" AS source_uri, target_data.\"{}\" AS target_uri, ST_RELATE(source_data.geo, target_data.geo) AS matrix,
+                    ST_DIMENSION(source_data.geo) AS source_dimension, ST_DIMENSION(target_data.geo) AS target_dimension
+                FROM ({}) AS source_data
+                INNER JOIN
+                ({}) AS target_data
+                ON ST_INTERSECTS(source_data.geo, target_data.geo){}
+                OFFSET 0
+            ) AS pairs
+            CROSS JOIN LATERAL (VALUES {}) AS relations(relation, holds)
+            WHERE relations.holds
+            """.format(self.config.get_var_uri('source'), self.config.get_var_uri('target'), source_query, target_query, tile_condition,
+                       relations)
+
+    def build_disjoint_query(self, source_query, target_query):
+        # ST_Disjoint cannot use the GIST index, so the uri pairs all of whose geometries intersect are found with it
+        # instead, and the other pairs of the distinct uris of both sides are disjoint. The uris are distinct before
+        # the cross product, so its rows stream through a hash anti-join.
+        return """
+            SELECT sources.source_uri, targets.target_uri
+            FROM (SELECT DISTINCT \"{0}\" AS source_uri FROM ({2}) AS source_data) AS sources
+            CROSS JOIN
+            (SELECT DISTINCT \"{1}\" AS target_uri FROM ({3}) AS target_data) AS targets
+            LEFT JOIN ({4}) AS intersecting ON intersecting.source_uri = sources.source_uri AND intersecting.target_uri = targets.target_uri
+            WHERE intersecting.source_uri IS NULL
+            """.format(self.config.get_var_uri('source'), self.config.get_var_uri('target'), source_query, target_query,
+                       self.build_intersecting_query(source_query, target_query))
+
+    def build_compact_disjoint_query(self, source_query, target_query):
+        # Returns every source uri with the target uris it is not disjoint from, the targets all of whose geometries
+        # intersect all geometries of the source. The source is disjoint from every other target.
+        return """
+            SELECT sources.source_uri, COALESCE(intersecting.target_uris, '{{}}')
+            FROM (SELECT DISTINCT \"{0}\" AS source_uri FROM ({1}) AS source_data) AS sources
+            LEFT JOIN (
+                SELECT pairs.source_uri, array_agg(pairs.target_uri ORDER BY pairs.target_uri) AS target_uris
+                FROM ({2}) AS pairs
+                GROUP BY pairs.source_uri
+            ) AS intersecting ON intersecting.source_uri = sources.source_uri
+            """.format(self.config.get_var_uri('source'), source_query, self.build_intersecting_query(source_query, target_query))
+
+    def build_intersecting_query(self, source_query, target_query):
+        # Returns the uri pairs all of whose geometries intersect, the pairs that are not disjoint
+        source_counts = 'SELECT \"{0}\" AS source_uri, COUNT(*) AS geometries FROM ({1}) AS source_data GROUP BY \"{0}\"'.format(
+            self.config.get_var_uri('source'), source_query)
+        target_counts = 'SELECT \"{0}\" AS target_uri, COUNT(*) AS geometries FROM ({1}) AS target_data GROUP BY \"{0}\"'.format(
+            self.config.get_var_uri('target'), target_query)
+
+        return """
+                SELECT pairs.source_uri, pairs.target_uri
+                FROM (
+                    SELECT source_data.\"{2}\" AS source_uri, target_data.\"{3}\" AS target_uri, COUNT(*) AS intersecting
+                    FROM ({4}) AS source_data
+                    INNER JOIN
+                    ({5}) AS target_data
+                    ON ST_INTERSECTS(source_data.geo, target_data.geo)
+                    GROUP BY source_data.\"{2}\", target_data.\"{3}\"
+                ) AS pairs
+                JOIN ({0}) AS source_counts ON source_counts.source_uri = pairs.source_uri
+                JOIN ({1}) AS target_counts ON target_counts.target_uri = pairs.target_uri
+                WHERE pairs.intersecting = source_counts.geometries * target_counts.geometries
+                """.format(source_counts, target_counts, self.config.get_var_uri('source'), self.config.get_var_uri('target'), source_query,
+                           target_query)
+
+    def build_nearest_query(self, source_query, target_query, relation_function):
+        # Links every source geometry with its k nearest target geometries (within the threshold, if one is given).
+        # Distances are ranked with the GIST index through <->, Hausdorff distances by computing them.
+        if self.config.get_threshold() is not None:
+            condition = 'WHERE ST_DWITHIN(source_data.geo, target_data.geo, {})'.format(float(self.config.get_threshold()))
+        else:
+            condition = ''
+
+        if self.relation == 'distance':
+            order = 'target_data.geo <-> source_data.geo'
+        else:
+            order = 'distance'
+
+        return """
+            SELECT nearest.distance, source_data.\"{}\" AS source_uri, nearest.target_uri
+            FROM ({}) AS source_data
+            CROSS JOIN LATERAL (
+                SELECT {}(source_data.geo, target_data.geo) AS distance, target_data.\"{}\" AS target_uri
+                FROM ({}) AS target_data
+                {}
+                ORDER BY {}
+                LIMIT {}
+            ) AS nearest
+            """.format(self.config.get_var_uri('source'), source_query, relation_function, self.config.get_var_uri('target'), target_query,
+                       condition, order, self.config.get_k())
+
+    def iterate_query(self, query, connection=None):
+        # Yields the result rows in batches from a server-side cursor. The query runs until the first batch arrives,
+        # which the trace records as the join, the following batches as the fetch. A given connection is left open.
+        # PostgreSQL never plans the query of a cursor in parallel, map_partitions spreads a mapping over connections.
+        owned = connection is None
+
+        if owned:
+            connection = psycopg2.connect(self.config.get_database_string())
+
+        try:
+            if self.config.get_explain():
+                # ANALYZE runs the query, so it is joined twice. It is explained as a cursor, which is planned without
+                # parallel workers and for fetching its first rows, like the one the rows are read from.
+                with self.tracer.span('explain'):
+                    cursor = connection.cursor()
+                    cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) DECLARE mapping_plan CURSOR FOR ' + query)
+                    self.tracer.add_plan(query, cursor.fetchone()[0])
+                    cursor.close()
+
+            start = time.time()
+            cursor = connection.cursor(name='mapping')
+            cursor.execute(query)
+            rows = cursor.fetchmany(BATCH_SIZE)
+            self.tracer.add('join', start, time.time() - start, query=query, rows=len(rows))
+            start = time.time()
+            duration = 0
+            count = 0
+
+            while len(rows) > 0:
+                yield rows
+                resumed = time.time()
+                rows = cursor.fetchmany(BATCH_SIZE)
+                duration += time.time() - resumed
+                count += len(rows)
+
+            self.tracer.add('fetch', start, duration, rows=count)
+            cursor.close()
+        finally:
+            if owned:
+                connection.close()
+
+    def map_partitions(self, source_query, target_query, relation_function, workers):
+        # Splits the source rows into server_offset ranges of equal size and joins each range on its own connection,
+        # yielding the batches of all partitions as they arrive. A uri with several geometries can be related in more
+        # than one range, those pairs are de-duplicated here.
+        connection = psycopg2.connect(self.config.get_database_string())
+        cursor = connection.cursor()
+        cursor.execute("""
+        SELECT MIN(server_offset), MAX(server_offset)
+        FROM (
+            SELECT server_offset, NTILE(%s) OVER (ORDER BY server_offset) AS part
+            FROM ({}) AS source_data
+        ) AS partitions
+        GROUP BY part
+        ORDER BY part""".format(source_query), (workers,))
+        partitions = cursor.fetchall()
+        cursor.execute("""
+        SELECT \"{0}\"
+        FROM ({1}) AS source_data
+        GROUP BY \"{0}\"
+        HAVING COUNT(*) > 1""".format(self.config.get_var_uri('source'), source_query))
+        shared_uris = set(row[0] for row in cursor.fetchall())
+        cursor.close()
+        connection.close()
+
+        distinct = self.relation != 'distance' and self.relation != 'hausdorff_distance'
+        seen = set()
+        # Bounded, so partitions wait for the writer instead of piling up batches
+        batches = Queue(maxsize=workers * 2)
+        stop = Event()
+        threads = []
+        connections = []
+
+        try:
+            for number, (start_offset, end_offset) in enumerate(partitions):
+                partition_query = 'SELECT * FROM ({}) AS source_rows WHERE server_offset BETWEEN {} AND {}'.format(
+                    source_query, start_offset, end_offset)
+                connections.append(psycopg2.connect(self.config.get_database_string()))
+                thread = Thread(target=self.run_partition, args=(batches, stop, connections[-1], (number, start_offset, end_offset),
+                                                                 partition_query, target_query, relation_function), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+            running = len(threads)
+
+            while running > 0:
+                number, rows, error = batches.get()
+
+                if error is not None:
+                    raise error
+
+                if rows is None:
+                    running -= 1
+                    continue
+
+                if distinct and len(shared_uris) > 0:
+                    unique_rows = []
+
+                    for row in rows:
+                        if row[0] in shared_uris:
+                            if row in seen:
+                                continue
+
+                            seen.add(row)
+
+                        unique_rows.append(row)
+
+                    rows = unique_rows
+
+                yield rows
+        finally:
+            # Stops the partitions that are still running when a partition failed or the batches were not all
+            # consumed, cancelling their queries, and waits for them before their connections are closed
+            stop.set()
+
+            for thread, connection in zip(threads, connections):
+                if thread.is_alive():
+                    connection.cancel()
+
+            while any(thread.is_alive() for thread in threads):
+                try:
+                    batches.get(timeout=QUEUE_TIMEOUT)
+                except Empty:
+                    pass
+
+            for thread in threads:
+                thread.join()
+
+            for connection in connections:
+                connection.close()
+
+    def run_partition(self, batches, stop, connection, partition, source_query, target_query, relation_function):
+        number, start_offset, end_offset = partition
+        start = time.time()
+        count = 0
+        partition_batches = self.iterate_query(self.build_query(source_query, target_query, relation_function), connection)
+
+        try:
+            for rows in partition_batches:
+                count += len(rows)
+
+                if not self.put_batch(batches, stop, (number, rows, None)):
+                    return
+        except Exception as e:
+            self.put_batch(batches, stop, (number, None, e))
+            return
+        finally:
+            partition_batches.close()
+
+        self.info_logger.logger.log(INFO, "Partition {} (server offsets {} - {}) took {}s, {} mappings".format(
+            number, start_offset, end_offset, round(time.time() - start, 4), count))
+        self.put_batch(batches, stop, (number, None, None))
+
+    def put_batch(self, batches, stop, batch):
+        # Waits for room in the queue until the partitions are stopped, returns whether the batch was put
+        while not stop.is_set():
+            try:
+                batches.put(batch, timeout=QUEUE_TIMEOUT)
+                return True
+            except Full:
+                pass
+
+        return False
+
+    def map_tiles(self, source_query, target_query, relation_function):
+        # Joins the tiles of a quadtree over both sides one by one, or on measure workers, and stores the links of every
+        # tile as it finishes. A stopped run continues with the tiles it did not finish. The links of all tiles are
+        # yielded once every tile is mapped.
+        run_key = md5(json.dumps([source_query, target_query, self.relations, self.config.get_threshold(),
+                                  self.config.get_tile_rows()]).encode('utf-8')).hexdigest()
+        checkpoint = TileCheckpoint(self.config, self.source_sparql.get_query_hash(), self.target_sparql.get_query_hash(), run_key)
+        found = checkpoint.find()
+
+        if found is None:
+            tiles = self.build_tiles(source_query, target_query)
+            checkpoint.start(tiles)
+            total = len(tiles)
+            self.info_logger.logger.log(INFO, "Mapping {} tiles".format(total))
+        else:
+            tiles, total = found
+            self.info_logger.logger.log(INFO, "Resuming tiled mapping, {} of {} tiles left".format(len(tiles), total))
+
+        srids = (self.get_srid(source_query), self.get_srid(target_query))
+
+        if self.config.get_measure_workers() > 1:
+            with ThreadPoolExecutor(max_workers=self.config.get_measure_workers()) as executor:
+                list(executor.map(lambda tile: self.run_tile(checkpoint, tile, total, source_query, target_query, relation_function, srids),
+                                  tiles))
+        else:
+            for tile in tiles:
+                self.run_tile(checkpoint, tile, total, source_query, target_query, relation_function, srids)
+
+        yield from checkpoint.iterate_links(self.relation != 'distance' and self.relation != 'hausdorff_distance')
+        checkpoint.clear()
+
+    def build_tiles(self, source_query, target_query):
+        # Counts the geometries of both sides by the centre of their bbox on a grid of 2^MAX_DEPTH cells per side over
+        # their extent, and splits the extent into quadtree tiles of at most tile_rows geometries. Returns the tiles as
+        # (number, xmin, ymin, xmax, ymax, last_column, last_row).
+        geometries_query = """
+            SELECT geo FROM ({}) AS source_data
+            UNION ALL
+            SELECT geo FROM ({}) AS target_data""".format(source_query, target_query)
         connection = psycopg2.connect(self.config.get_database_string())
         cursor = connection.cursor()
-        cursor.execute(query)
+        cursor.execute("""
+        SELECT ST_XMIN(extent), ST_YMIN(extent), ST_XMAX(extent), ST_YMAX(extent)
+        FROM (SELECT ST_EXTENT(geo) AS extent FROM ({}) AS geometries) AS data""".format(geometries_query))
+        xmin, ymin, xmax, ymax = cursor.fetchone()
+
+        if xmin is None:
+            cursor.close()
+            connection.close()
+            return []
+
+        size = 2 ** MAX_DEPTH
+        width = (xmax - xmin) / size or 1.0
+        height = (ymax - ymin) / size or 1.0
+        cursor.execute("""
+        SELECT column_number, row_number, COUNT(*)
+        FROM (
+            SELECT LEAST(FLOOR(((ST_XMIN(geo) + ST_XMAX(geo)) / 2 - %(xmin)s) / %(width)s)::INTEGER, %(last)s) AS column_number,
+                LEAST(FLOOR(((ST_YMIN(geo) + ST_YMAX(geo)) / 2 - %(ymin)s) / %(height)s)::INTEGER, %(last)s) AS row_number
+            FROM ({}) AS geometries
+        ) AS cells
+        GROUP BY column_number, row_number""".format(geometries_query),
+                       {'xmin': xmin, 'ymin': ymin, 'width': width, 'height': height, 'last': size - 1})
+        counts = dict(((column, row), count) for column, row, count in cursor.fetchall())
+        cursor.close()
+        connection.close()
+
+        return [(number, xmin + column * width, ymin + row * height, xmin + (column + tile_size) * width, ymin + (row + tile_size) * height,
+                 column + tile_size == size, row + tile_size == size)
+                for number, (column, row, tile_size) in enumerate(build_quadtree(counts, self.config.get_tile_rows()))]
+
+    def run_tile(self, checkpoint, tile, total, source_query, target_query, relation_function, srids):
+        # The source rows are taken from the tile expanded by the threshold, so the pairs within it are found in the tile
+        start = time.time()
+        number, xmin, ymin, xmax, ymax, _, _ = tile
+        envelope = 'ST_MAKEENVELOPE({}, {}, {}, {}, {{}})'.format(repr(xmin), repr(ymin), repr(xmax), repr(ymax))
+        source_tile_query = 'SELECT * FROM ({}) AS source_rows WHERE geo && ST_EXPAND({}, {})'.format(
+            source_query, envelope.format(srids[0]), repr(self.get_tile_distance()))
+        target_tile_query = 'SELECT * FROM ({}) AS target_rows WHERE geo && {}'.format(target_query, envelope.format(srids[1]))
+        query = self.build_query(source_tile_query, target_tile_query, relation_function, self.get_tile_condition(tile))
 
         if self.relation == 'distance' or self.relation == 'hausdorff_distance':
-            data_frame = DataFrame(cursor.fetchall(), columns=['distance', 'source_uri', 'target_uri'])
+            count = checkpoint.run_tile(number, query, "'{}'".format(self.relation), 'tile_data.distance')
+        elif len(self.relations) > 1:
+            count = checkpoint.run_tile(number, query, 'tile_data.relation', 'NULL')
         else:
-            data_frame = DataFrame(cursor.fetchall(), columns=['source_uri', 'target_uri'])
+            count = checkpoint.run_tile(number, query, "'{}'".format(self.relation), 'NULL')
+
+        self.tracer.add('tile', start, time.time() - start, tile=number, rows=count)
+        self.info_logger.logger.log(INFO, "Tile {} of {} took {}s, {} mappings".format(number + 1, total, round(time.time() - start, 4), count))
+
+    def get_tile_condition(self, tile):
+        # Pairs whose geometries reach into several tiles are only joined in the tile that holds the lower left corner
+        # of the overlap of their bboxes, with the source bbox expanded by the threshold. Tiles on the upper and right
+        # edge of the extent also hold the corners on that edge.
+        _, xmin, ymin, xmax, ymax, last_column, last_row = tile
+        distance = repr(self.get_tile_distance())
+        x = 'GREATEST(ST_XMIN(source_data.bbox) - {}, ST_XMIN(target_data.bbox))'.format(distance)
+        y = 'GREATEST(ST_YMIN(source_data.bbox) - {}, ST_YMIN(target_data.bbox))'.format(distance)
+        condition = ' AND {} >= {} AND {} >= {}'.format(x, repr(xmin), y, repr(ymin))
+
+        if not last_column:
+            condition += ' AND {} < {}'.format(x, repr(xmax))
+
+        if not last_row:
+            condition += ' AND {} < {}'.format(y, repr(ymax))
+
+        return condition
+
+    def get_tile_distance(self):
+        if self.relation in ['distance', 'distance_within', 'hausdorff_distance']:
+            return float(self.config.get_threshold())
 
+        return 0.0
+
+    def get_srid(self, query):
+        connection = psycopg2.connect(self.config.get_database_string())
+        cursor = connection.cursor()
+        cursor.execute('SELECT ST_SRID(geo) FROM ({}) AS data LIMIT 1'.format(query))
+        result = cursor.fetchone()
         cursor.close()
         connection.close()
-        data_frame.insert(1, 'relation', self.relation)
-        end = time.time()
 
-        self.info_logger.logger.log(INFO, "Mapping took: {}s".format(round(end - start, 4)))
-        self.info_logger.logger.log(INFO, "{} mappings found".format(len(data_frame)))
+        return result[0] if result is not None else 0
 
-        formatted_results = self.convert(data_frame)
+    def build_pieces_query(self, source_query, target_query, relation_function, tile_condition=''):
+        # Joins the subdivided pieces of the geometries (or the whole geometries of a side that is not subdivided). A pair
+        # is related by intersects or distance_within if any two of its pieces are. For the other relations the pieces
+        # only find the intersecting pairs, which are then tested on the whole geometries.
+        pieces_queries = []
 
-        if to_file:
-            self.result_logger.logger.info(formatted_results)
+        for type, query in [('source', source_query), ('target', target_query)]:
+            if self.config.get_subdivide(type) is not None:
+                pieces_queries.append("""
+                SELECT data.geometry_id, pieces.piece
+                FROM ({}) AS data
+                JOIN {} AS pieces ON pieces.geometry_id = data.geometry_id""".format(query, 'pieces_' + self.get_query_hash(type)))
+            else:
+                pieces_queries.append('SELECT data.geometry_id, data.geo AS piece FROM ({}) AS data'.format(query))
 
-        return formatted_results
+        if self.relation in PIECE_RELATIONS:
+            condition = self.get_condition(relation_function, 'source_pieces.piece', 'target_pieces.piece')
+        else:
+            condition = 'ST_INTERSECTS(source_pieces.piece, target_pieces.piece)'
+
+        candidates_query = """
+            SELECT DISTINCT source_pieces.geometry_id AS source_id, target_pieces.geometry_id AS target_id
+            FROM ({}) AS source_pieces
+            INNER JOIN
+            ({}) AS target_pieces
+            ON {}""".format(pieces_queries[0], pieces_queries[1], condition)
+
+        if self.relation in PIECE_RELATIONS:
+            pair_condition = 'TRUE'
+        else:
+            pair_condition = self.get_prefilter() + self.get_condition(relation_function, 'source_data.geo', 'target_data.geo')
+
+        return """
+            SELECT DISTINCT source_data.\"{}\" AS source_uri, target_data.\"{}\" AS target_uri
+            FROM ({}) AS candidates
+            JOIN ({}) AS source_data ON source_data.geometry_id = candidates.source_id
+            JOIN ({}) AS target_data ON target_data.geometry_id = candidates.target_id
+            WHERE {}{}
+            """.format(self.config.get_var_uri('source'), self.config.get_var_uri('target'), candidates_query, source_query, target_query,
+                       pair_condition, tile_condition)
+
+    def get_query_hash(self, type):
+        if type == 'source':
+            return self.source_sparql.get_query_hash()
+
+        return self.target_sparql.get_query_hash()
+
+    def get_condition(self, relation_function, source_geo, target_geo):
+        if self.relation == 'distance_within':
+            return '{}({}, {}, {})'.format(relation_function, source_geo, target_geo, float(self.config.get_threshold()))
+
+        return '{}({}, {})'.format(relation_function, source_geo, target_geo)
+
+    def get_prefilter(self):
+        # Cheap conditions on the stored bbox, area and geometry type that every matching pair fulfils, checked before
+        # the exact predicate. Areas get a small tolerance for rounding.
+        if self.relation in ['within', 'covered_by']:
+            return 'source_data.bbox @ target_data.bbox AND source_data.area <= target_data.area * 1.000001 AND '
+        elif self.relation in ['contains', 'contains_properly', 'covers']:
+            return 'source_data.bbox ~ target_data.bbox AND source_data.area * 1.000001 >= target_data.area AND '
+        elif self.relation == 'equals':
+            return 'source_data.bbox ~= target_data.bbox AND '
+        elif self.relation in ['touches', 'crosses']:
+            # Two points never touch or cross each other
+            return "(source_data.geometry_type <> 'POINT' OR target_data.geometry_type <> 'POINT') AND "
+
+        return ''
 
-    def convert(self, results):
-        formatted_results = None
+    def write_results(self, batches, output):
+        # Writes the batches of links in the output format and returns the number of links
         output_format = self.config.get_output_format()
+        distance = self.relation == 'distance' or self.relation == 'hausdorff_distance'
+        count = 0
+
+        if self.config.get_compact():
+            return self.write_compact_results(batches, output)
+        elif output_format.lower() in ['turtle', 'nt']:
+            # TODO: Turtle output for distance measures
+            writer = csv.writer(output, delimiter=' ', lineterminator='\n')
 
-        # TODO: Turtle output for distance measures
-        if output_format.lower() in ['turtle','nt']:
-            results.insert(2, 'end', '.')
-            
-            results['source_uri'] = '<' + results['source_uri'].astype(str) + '>'
-            results['relation'] = self.relationToGeoSPARQLFunc(self.relation)
-            results['target_uri'] = '<' + results['target_uri'].astype(str) + '>'
-            formatted_results = results.to_csv(columns=['source_uri', 'relation', 'target_uri', 'end'], header=False, index=False, index_label=False, sep=' ')    
+            for links in batches:
+                writer.writerows(['<{}>'.format(source_uri), self.relationToGeoSPARQLFunc(relation), '<{}>'.format(target_uri), '.']
+                                 for source_uri, relation, target_uri, _ in links)
+                count += len(links)
         elif output_format == 'json':
-            formatted_results = results.to_json(na='drop')
+            output.write('[')
+
+            for links in batches:
+                for source_uri, relation, target_uri, link_distance in links:
+                    result = {'source_uri': source_uri, 'relation': relation, 'target_uri': target_uri}
+
+                    if distance:
+                        result['distance'] = link_distance
+
+                    output.write('{}\n{}'.format(',' if count > 0 else '', json.dumps(result)))
+                    count += 1
+
+            output.write('\n]\n' if count > 0 else ']\n')
         else:
-            if 'distance' in results or 'hausdorff_distance' in results:
-                formatted_results = results.to_csv(columns=['source_uri', 'relation', 'target_uri', 'distance'],
-                                                   header=True, index=False, index_label=False)
+            writer = csv.writer(output, lineterminator='\n')
+
+            if distance:
+                writer.writerow(['source_uri', 'relation', 'target_uri', 'distance'])
+                row_size = 4
             else:
-                formatted_results = results.to_csv(columns=['source_uri', 'relation', 'target_uri'],
-                                                   header=True, index=False, index_label=False)
+                writer.writerow(['source_uri', 'relation', 'target_uri'])
+                row_size = 3
 
-        return formatted_results
+            for links in batches:
+                writer.writerows(link[:row_size] for link in links)
+                count += len(links)
+
+        return count
+
+    def write_compact_results(self, batches, output):
+        # Compact links hold the list of target uris the source is not disjoint from in place of the target uri
+        count = 0
+
+        if self.config.get_output_format() == 'json':
+            output.write('[')
+
+            for links in batches:
+                for source_uri, relation, target_uris, _ in links:
+                    result = {'source_uri': source_uri, 'relation': relation, 'except_target_uris': target_uris}
+                    output.write('{}\n{}'.format(',' if count > 0 else '', json.dumps(result)))
+                    count += 1
+
+            output.write('\n]\n' if count > 0 else ']\n')
+        else:
+            writer = csv.writer(output, lineterminator='\n')
+            writer.writerow(['source_uri', 'relation', 'except_target_uris'])
+
+            for links in batches:
+                writer.writerows([source_uri, relation, ' '.join(target_uris)] for source_uri, relation, target_uris, _ in links)
+                count += len(links)
+
+        return count
+
+    def get_links(self, rows):
+        # Returns the rows of any mapping query as (source_uri, relation, target_uri, distance)
+        if self.relation == 'distance' or self.relation == 'hausdorff_distance':
+            return [(row[1], self.relation, row[2], row[0]) for row in rows]
+        elif len(self.relations) > 1:
+            return [(row[0], row[1], row[2], None) for row in rows]
+
+        return [(row[0], self.relation, row[1], None) for row in rows]
 
     def relationToGeoSPARQLFunc(self, relation):
         #geofURITemplate = "<http://www.opengis.net/def/function/geosparql/{}>"
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from catalog import CacheCatalog
+from hashlib import md5
+from psycopg2.extras import execute_values
+
+import json
+import psycopg2
+
+# Links read from or written to the result tables at once
+BATCH_SIZE = 10000
+
+
+def get_input_key(config, source_hash, target_hash):
+    return md5(json.dumps({
+        'source': [source_hash, config.get_offset('source'), config.get_limit('source')],
+        'target': [target_hash, config.get_offset('target'), config.get_limit('target')],
+        'relations': config.get_relations(),
+        'threshold': config.get_threshold(),
+        'k': config.get_k()
+    }, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Stored links of earlier mappings. Results are keyed by the mapping inputs (caches, offset/limit windows, relations,
+# threshold and k) and hold the versions the source and target caches had when they were mapped, so they are reused
+# until either cache changes.
+class ResultCache:
+    def __init__(self, config, source_hash, target_hash):
+        self.config = config
+        self.source_hash = source_hash
+        self.target_hash = target_hash
+        self.catalog = CacheCatalog(config.database_config)
+        self.input_key = get_input_key(config, source_hash, target_hash)
+        self.source_version = None
+        self.target_version = None
+
+    def create_tables(self, cursor):
+        self.catalog.create_table(cursor)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mapping_results(input_key CHAR(32) PRIMARY KEY, source_hash VARCHAR, source_version BIGINT,
+            target_hash VARCHAR, target_version BIGINT, link_count BIGINT, created_at TIMESTAMP)""")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mapping_links(input_key CHAR(32), source_uri VARCHAR, relation VARCHAR, target_uri VARCHAR,
+            distance DOUBLE PRECISION)""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_input_key_mapping_links ON mapping_links (input_key)")
+
+    def find(self):
+        # Returns the number of stored links if they are still valid, None otherwise
+        connection = psycopg2.connect(self.config.get_database_string())
+        cursor = connection.cursor()
+        self.create_tables(cursor)
+        connection.commit()
+        self.source_version = self.catalog.get_version(cursor, self.source_hash)
+        self.target_version = self.catalog.get_version(cursor, self.target_hash)
+        cursor.execute("""
+        SELECT link_count FROM mapping_results
+        WHERE input_key = %s AND source_version = %s AND target_version = %s""", (self.input_key, self.source_version, self.target_version))
+        result = cursor.fetchone()
+        cursor.close()
+        connection.close()
+
+        return result[0] if result is not None else None
+
+    def iterate_links(self):
+        connection = psycopg2.connect(self.config.get_database_string())
+
+        try:
+            cursor = connection.cursor(name='links')
+            cursor.execute("SELECT source_uri, relation, target_uri, distance FROM mapping_links WHERE input_key = %s", (self.input_key,))
+
+            while True:
+                links = cursor.fetchmany(BATCH_SIZE)
+
+                if len(links) == 0:
+                    break
+
+                yield links
+
+            cursor.close()
+        finally:
+            connection.close()
+
+    def store(self, batches):
+        # Passes the link batches through while storing them, the result is only recorded once all links are written
+        connection = psycopg2.connect(self.config.get_database_string())
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute("DELETE FROM mapping_results WHERE input_key = %s", (self.input_key,))
+            cursor.execute("DELETE FROM mapping_links WHERE input_key = %s", (self.input_key,))
+            count = 0
+
+            for links in batches:
+                execute_values(cursor, "INSERT INTO mapping_links (input_key, source_uri, relation, target_uri, distance) VALUES %s",
+                               [(self.input_key,) + tuple(link) for link in links], page_size=BATCH_SIZE)
+                count += len(links)
+                yield links
+
+            cursor.execute("""
+            INSERT INTO mapping_results (input_key, source_hash, source_version, target_hash, target_version, link_count, created_at)
+            VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
+                           (self.input_key, self.source_hash, self.source_version, self.target_hash, self.target_version, count))
+
+            connection.commit()
+            cursor.close()
+        finally:
+            connection.close()
+
+
+# Links of incremental mappings, stored by geometry id. The state records up to which cache versions the links are
+# complete, so a run only has to join the members added since. Links of geometries that are no longer members of a
+# cache are left out when the links are read.
+class IncrementalLinks:
+    def __init__(self, config, source_hash, target_hash):
+        self.config = config
+        self.source_hash = source_hash
+        self.target_hash = target_hash
+        self.catalog = CacheCatalog(config.database_config)
+        self.input_key = get_input_key(config, source_hash, target_hash)
+        self.connection = None
+        self.cursor = None
+
+    def create_tables(self, cursor):
+        self.catalog.create_table(cursor)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS incremental_state(input_key CHAR(32) PRIMARY KEY, source_hash VARCHAR, source_version BIGINT,
+            target_hash VARCHAR, target_version BIGINT, updated_at TIMESTAMP)""")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS incremental_links(input_key CHAR(32), source_id BIGINT, relation VARCHAR, target_id BIGINT,
+            distance DOUBLE PRECISION)""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_input_key_incremental_links ON incremental_links (input_key)")
+
+    def begin(self):
+        # Opens the transaction of this run and returns the recorded and the current versions of source and target.
+        # The state row is locked, so concurrent runs of the same mapping wait for each other.
+        self.connection = psycopg2.connect(self.config.get_database_string())
+        self.cursor = self.connection.cursor()
+        self.create_tables(self.cursor)
+        self.connection.commit()
+        self.cursor.execute("""
+        INSERT INTO incremental_state (input_key, source_hash, target_hash) VALUES (%s, %s, %s)
+        ON CONFLICT (input_key) DO NOTHING""", (self.input_key, self.source_hash, self.target_hash))
+        self.cursor.execute("SELECT source_version, target_version FROM incremental_state WHERE input_key = %s FOR UPDATE", (self.input_key,))
+        recorded = self.cursor.fetchone()
+        current = (self.catalog.get_version(self.cursor, self.source_hash), self.catalog.get_version(self.cursor, self.target_hash))
+
+        if recorded[0] is None or recorded[1] is None:
+            recorded = None
+
+        return recorded, current
+
+    def clear(self):
+        self.cursor.execute("DELETE FROM incremental_links WHERE input_key = %s", (self.input_key,))
+
+    def add(self, batches):
+        count = 0
+
+        for links in batches:
+            execute_values(self.cursor, "INSERT INTO incremental_links (input_key, source_id, relation, target_id, distance) VALUES %s",
+                           [(self.input_key,) + tuple(link) for link in links], page_size=BATCH_SIZE)
+            count += len(links)
+
+        return count
+
+    def commit(self, versions):
+        self.cursor.execute("""
+        UPDATE incremental_state SET source_version = %s, target_version = %s, updated_at = NOW()
+        WHERE input_key = %s""", (versions[0], versions[1], self.input_key))
+        self.connection.commit()
+        self.cursor.close()
+        self.connection.close()
+
+    def rollback(self):
+        if self.connection is not None and not self.connection.closed:
+            self.connection.close()
+
+    def iterate_links(self, source_query, target_query, distinct):
+        # Yields the stored links as (source_uri, relation, target_uri, distance) for the given source and target rows
+        connection = psycopg2.connect(self.config.get_database_string())
+
+        try:
+            cursor = connection.cursor(name='links')
+            cursor.execute("""
+            SELECT {0} source_data.\"{1}\", links.relation, target_data.\"{2}\", links.distance
+            FROM incremental_links AS links
+            JOIN ({3}) AS source_data ON source_data.geometry_id = links.source_id
+            JOIN ({4}) AS target_data ON target_data.geometry_id = links.target_id
+            WHERE links.input_key = %s""".format('DISTINCT' if distinct else '', self.config.get_var_uri('source'),
+                                                 self.config.get_var_uri('target'), source_query, target_query), (self.input_key,))
+
+            while True:
+                links = cursor.fetchmany(BATCH_SIZE)
+
+                if len(links) == 0:
+                    break
+
+                yield links
+
+            cursor.close()
+        finally:
+            connection.close()
+
+
+# Checkpoint of a tiled mapping. A run stores its tiles and the links of every finished tile, so a mapping that was
+# stopped continues with the first unfinished tile, as long as both caches are unchanged. The run key identifies the
+# mapping queries and settings the tiles were built for.
+class TileCheckpoint:
+    def __init__(self, config, source_hash, target_hash, run_key):
+        self.config = config
+        self.source_hash = source_hash
+        self.target_hash = target_hash
+        self.catalog = CacheCatalog(config.database_config)
+        self.run_key = run_key
+        self.source_version = None
+        self.target_version = None
+
+    def create_tables(self, cursor):
+        self.catalog.create_table(cursor)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tile_runs(run_key CHAR(32) PRIMARY KEY, source_hash VARCHAR, source_version BIGINT, target_hash VARCHAR,
+            target_version BIGINT, created_at TIMESTAMP)""")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tile_state(run_key CHAR(32), tile INTEGER, xmin DOUBLE PRECISION, ymin DOUBLE PRECISION,
+            xmax DOUBLE PRECISION, ymax DOUBLE PRECISION, last_column BOOLEAN, last_row BOOLEAN, link_count BIGINT, finished_at TIMESTAMP,
+            PRIMARY KEY (run_key, tile))""")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS tile_links(run_key CHAR(32), tile INTEGER, source_uri VARCHAR, relation VARCHAR, target_uri VARCHAR,
+            distance DOUBLE PRECISION)""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_run_key_tile_links ON tile_links (run_key)")
+
+    def find(self):
+        # Returns the unfinished tiles and the number of all tiles of a run for the current cache versions, None if
+        # there is none. Runs for other versions are removed.
+        connection = psycopg2.connect(self.config.get_database_string())
+        cursor = connection.cursor()
+        self.create_tables(cursor)
+        self.source_version = self.catalog.get_version(cursor, self.source_hash)
+        self.target_version = self.catalog.get_version(cursor, self.target_hash)
+        cursor.execute("SELECT source_version, target_version FROM tile_runs WHERE run_key = %s", (self.run_key,))
+        run = cursor.fetchone()
+        tiles = None
+
+        if run is not None and run[0] == self.source_version and run[1] == self.target_version:
+            cursor.execute("""
+            SELECT tile, xmin, ymin, xmax, ymax, last_column, last_row, finished_at IS NOT NULL
+            FROM tile_state
+            WHERE run_key = %s
+            ORDER BY tile""", (self.run_key,))
+            rows = cursor.fetchall()
+            tiles = ([tuple(row[:7]) for row in rows if not row[7]], len(rows))
+        elif run is not None:
+            self.delete(cursor)
+
+        connection.commit()
+        cursor.close()
+        connection.close()
+
+        return tiles
+
+    def start(self, tiles):
+        connection = psycopg2.connect(self.config.get_database_string())
+        cursor = connection.cursor()
+        self.delete(cursor)
+        cursor.execute("""
+        INSERT INTO tile_runs (run_key, source_hash, source_version, target_hash, target_version, created_at)
+        VALUES (%s, %s, %s, %s, %s, NOW())""", (self.run_key, self.source_hash, self.source_version, self.target_hash, self.target_version))
+        execute_values(cursor, "INSERT INTO tile_state (run_key, tile, xmin, ymin, xmax, ymax, last_column, last_row) VALUES %s",
+                       [(self.run_key,) + tuple(tile) for tile in tiles], page_size=BATCH_SIZE)
+        connection.commit()
+        cursor.close()
+        connection.close()
+
+    def run_tile(self, tile, query, relation, distance):
+        # Stores the links of the tile's mapping query and marks the tile finished in one transaction, so a stopped
+        # run never keeps the links of a tile it has to map again. Returns the number of links.
+        connection = psycopg2.connect(self.config.get_database_string())
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute("""
+            INSERT INTO tile_links (run_key, tile, source_uri, relation, target_uri, distance)
+            SELECT %s, %s, tile_data.source_uri, {}, tile_data.target_uri, {}
+            FROM ({}) AS tile_data""".format(relation, distance, query), (self.run_key, tile))
+            count = cursor.rowcount
+            cursor.execute("UPDATE tile_state SET link_count = %s, finished_at = NOW() WHERE run_key = %s AND tile = %s",
+                           (count, self.run_key, tile))
+            connection.commit()
+            cursor.close()
+        finally:
+            connection.close()
+
+        return count
+
+    def iterate_links(self, distinct):
+        # Pairs of uris with several geometries can be found in more than one tile, distinct removes them
+        connection = psycopg2.connect(self.config.get_database_string())
+
+        try:
+            cursor = connection.cursor(name='links')
+            cursor.execute("SELECT {} source_uri, relation, target_uri, distance FROM tile_links WHERE run_key = %s".format(
+                'DISTINCT' if distinct else ''), (self.run_key,))
+
+            while True:
+                links = cursor.fetchmany(BATCH_SIZE)
+
+                if len(links) == 0:
+                    break
+
+                yield links
+
+            cursor.close()
+        finally:
+            connection.close()
+
+    def clear(self):
+        connection = psycopg2.connect(self.config.get_database_string())
+        cursor = connection.cursor()
+        self.delete(cursor)
+        connection.commit()
+        cursor.close()
+        connection.close()
+
+    def delete(self, cursor):
+        cursor.execute("DELETE FROM tile_links WHERE run_key = %s", (self.run_key,))
+        cursor.execute("DELETE FROM tile_state WHERE run_key = %s", (self.run_key,))
+        cursor.execute("DELETE FROM tile_runs WHERE run_key = %s", (self.run_key,))
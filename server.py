@@ -4,7 +4,7 @@
 from argparse import ArgumentParser
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
-from tornado.web import Application, RequestHandler
+from tornado.web import Application, HTTPError, RequestHandler
 
 import json
 import os
@@ -44,6 +44,33 @@ class geoLIMESHandler(RequestHandler):
         self.set_header('Content-Type', responseContentType)
 
 
+class CacheHandler(RequestHandler):
+    def initialize(self, geolimes):
+        self.geolimes = geolimes
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(self.geolimes.list_caches()))
+
+    def post(self):
+        # Warms the caches of the posted config
+        config_json = json.loads(self.request.body)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(self.geolimes.warm(config_json)))
+
+    def delete(self):
+        # Evicts the caches given as query_hash arguments, or applies the eviction policy
+        query_hashes = self.get_arguments('query_hash')
+
+        try:
+            evicted = self.geolimes.evict(query_hashes or None)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(evicted))
+
+
 def get_arguments():
     parser = ArgumentParser(description="Python LIMES")
     parser.add_argument("-d", "--database", type=str, dest="database_config_file", help="Path to a database config file", required=True)
@@ -54,7 +81,8 @@ def get_arguments():
 
 def create_app(geolimes):
     return Application([
-        (r"/limes", geoLIMESHandler, {'geolimes': geolimes})
+        (r"/limes", geoLIMESHandler, {'geolimes': geolimes}),
+        (r"/caches", CacheHandler, {'geolimes': geolimes})
     ])
 
 
@@ -2,12 +2,11 @@
 # -*- coding: utf-8 -*-
 
 from hashlib import md5
-from rdflib import Graph
-from rdflib.plugins.sparql.results.csvresults import CSVResultSerializer
-from SPARQLWrapper import SPARQLWrapper, CSV
-from SPARQLWrapper.SPARQLExceptions import EndPointInternalError, EndPointNotFound, SPARQLWrapperException, Unauthorized
+from urllib.error import HTTPError
 
+from local import LocalEndpoint
 from logger import ErrorLogger
+from transport import get_session
 
 import re
 
@@ -22,9 +21,21 @@ class SPARQL:
         self.query_hash = self.get_query_hash()
         self.sparql_error_logger = ErrorLogger('SparqlErrorLogger', 'sparql_errors', self.query_hash)
 
-    def build_query(self, offset, limit=None):
+    def build_query(self, offset, limit=None, after=None):
+        # In keyset mode, after is the last uri of the previous page and the number of rows with that uri already
+        # seen. The query then continues from that uri instead of skipping offset rows.
+        keyset = self.config.get_paging(self.type) == 'keyset'
+
+        if keyset and after is not None:
+            offset = after[1]
+
         if self.config.get_rawquery(self.type) is not None:
             query = self.config.get_rawquery(self.type)
+
+            if keyset:
+                position = query.rindex('}')
+                query = '{}{}{} {}'.format(query[:position], self.build_keyset_filter(after), query[position:], self.build_keyset_order())
+
             query_offset = 'OFFSET {}'.format(offset) if self.config.get_endpoint_type(self.type) == 'remote' else ''
             query = '{} {}'.format(query, query_offset)
             query_limit = 'LIMIT {}'.format(limit) if self.config.get_endpoint_type(self.type) == 'remote' else ''
@@ -36,9 +47,13 @@ class SPARQL:
             query_prefixes = self.build_prefixes()
             query_select = 'SELECT DISTINCT ?{} ?{}'.format(self.config.get_var_uri(self.type), self.config.get_var_shape(self.type))
             query_from = 'FROM <{}>'.format(self.config.get_graph(self.type))
-            query_where = self.build_where()
+            query_where = self.build_where(after)
             query_offset = 'OFFSET {}'.format(offset) if self.config.get_endpoint_type(self.type) == 'remote' else ''
             query_limit = 'LIMIT {}'.format(limit) if self.config.get_endpoint_type(self.type) == 'remote' else ''
+
+            if keyset:
+                query_where = '{} {}'.format(query_where, self.build_keyset_order())
+
             query = '{} {} {} {} {}'.format(query_prefixes, query_select, query_from, query_where, query_offset)
 
             if limit is None:
@@ -46,6 +61,24 @@ class SPARQL:
 
             return '{} {}'.format(query, query_limit)
 
+    def build_count_query(self):
+        query_prefixes = self.build_prefixes()
+        query_select = 'SELECT DISTINCT ?{} ?{}'.format(self.config.get_var_uri(self.type), self.config.get_var_shape(self.type))
+        query_from = 'FROM <{}>'.format(self.config.get_graph(self.type))
+        query_where = self.build_where()
+
+        return '{} SELECT (COUNT(*) AS ?count) {} WHERE {{ {} {} }}'.format(query_prefixes, query_from, query_select, query_where)
+
+    def build_keyset_filter(self, after):
+        if after is None:
+            return ''
+
+        uri = after[0].replace('\\', '\\\\').replace('"', '\\"')
+        return ' FILTER(STR(?{}) >= "{}") '.format(self.config.get_var_uri(self.type), uri)
+
+    def build_keyset_order(self):
+        return 'ORDER BY STR(?{}) STR(?{})'.format(self.config.get_var_uri(self.type), self.config.get_var_shape(self.type))
+
     def build_prefixes(self):
         prefixes = self.config.get_prefixes()
 
@@ -63,7 +96,7 @@ class SPARQL:
 
         return query_prefixes
 
-    def build_where(self):
+    def build_where(self, after=None):
         restriction = self.config.get_restriction(self.type)
         property = self.config.get_property(self.type)
         query_where = 'WHERE {'
@@ -74,6 +107,9 @@ class SPARQL:
         if property is not None:
             query_where += property + ' . '
 
+        if after is not None:
+            query_where += self.build_keyset_filter(after).strip() + ' '
+
         query_where += '}'
 
         return query_where
@@ -86,35 +122,27 @@ class SPARQL:
 
         return query
 
-    def query(self, offset, limit=None):
-        query = self.build_query(offset, limit)
-
-        if self.config.get_endpoint_type(self.type) == 'remote': 
-            sparql = SPARQLWrapper(self.config.get_endpoint(self.type))
-            sparql.customHttpHeaders['Accept-Encoding'] = 'gzip'
-            sparql.setQuery(query)
-            sparql.setReturnFormat(CSV)
-
-            try:
-                return sparql.query()
-            except EndPointNotFound as e:
-                print(e)
-            except Unauthorized as e:
-                print(e)
-            except EndPointInternalError as e:
-                print(e)
-            except SPARQLWrapperException as e:
-                print(e)
-        elif self.config.get_endpoint_type(self.type) == 'local': 
-            endpoint = self.config.get_endpoint(self.type)
-            endpoint.replace('file://', '')
-            graph = Graph()
-            graph.parse(endpoint, format='nt')
-            result = graph.query(query)
-            return result.serialize(format='csv')
+    def query(self, offset, limit=None, after=None):
+        query = self.build_query(offset, limit, after)
+
+        if self.config.get_endpoint_type(self.type) == 'remote':
+            return self.send(query)
+        elif self.config.get_endpoint_type(self.type) == 'local':
+            return LocalEndpoint(self.config, self.type).query(query)
 
         return None
 
+    def query_count(self):
+        return self.send(self.build_count_query())
+
+    def send(self, query):
+        try:
+            return get_session(self.config.get_endpoint(self.type)).query(self.config.get_endpoint(self.type), query,
+                                                                        self.config.get_timeout(self.type))
+        except HTTPError as e:
+            self.sparql_error_logger.logger.error("{} {}: {}".format(e.code, e.reason, query))
+            raise
+
     def get_query_hash(self):
         query = self.clean_query(self.build_query(0))
         return md5(query.encode('utf-8')).hexdigest()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from io import StringIO
+
+import csv
+import sys
+
+# WKT literals of large polygons easily exceed the default field size limit of the csv module
+csv.field_size_limit(sys.maxsize)
+
+
+# File-like object that feeds a SPARQL CSV result to COPY row by row, keeping only the given columns and appending a
+# server_offset counter if an offset is given. The output uses ';' as delimiter and has no header line. The last value
+# of the first column and how often it was repeated at the end are kept for keyset paging, the bytes read for tracing.
+class CSVStream:
+    def __init__(self, result, columns, offset=None):
+        self.reader = csv.reader(result)
+        self.offset = offset
+        self.size = 0
+        self.bytes = 0
+        self.buffer = StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=';', lineterminator='\n')
+        # Rows not yet read by COPY are pending[position:], the consumed part is only cut off once it outgrows the rest,
+        # so large WKT rows are not copied again on every read
+        self.pending = ''
+        self.position = 0
+        self.last = None
+        self.last_count = 0
+
+        header = next(self.reader, None)
+
+        if header is None:
+            self.indexes = None
+            return
+
+        self.indexes = []
+
+        for column in columns:
+            if column not in header:
+                raise Exception("Column {} not found in result (columns: {})".format(column, header))
+
+            self.indexes.append(header.index(column))
+
+    def read(self, size=-1):
+        while self.indexes is not None and (size is None or size < 0 or len(self.pending) - self.position < size):
+            row = next(self.reader, None)
+
+            if row is None:
+                self.indexes = None
+                break
+
+            self.write_row(row)
+
+        if size is None or size < 0 or len(self.pending) - self.position <= size:
+            data = self.pending[self.position:]
+            self.pending = ''
+            self.position = 0
+        else:
+            data = self.pending[self.position:self.position + size]
+            self.position += size
+
+        self.bytes += len(data.encode('utf-8'))
+
+        return data
+
+    def write_row(self, row):
+        values = [row[index] if index < len(row) else '' for index in self.indexes]
+
+        if self.offset is not None:
+            values.append(self.offset + self.size)
+
+        if values[0] == self.last:
+            self.last_count += 1
+        else:
+            self.last = values[0]
+            self.last_count = 1
+
+        self.writer.writerow(values)
+
+        if self.position > len(self.pending) - self.position:
+            self.pending = self.pending[self.position:]
+            self.position = 0
+
+        self.pending += self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.size += 1
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Shapely 2 is only needed for the strtree backend
+try:
+    import numpy
+    import shapely
+except ImportError:
+    shapely = None
+
+# Source rows mapped by one task of the process pool
+PARTITION_SIZE = 1000
+
+# Target geometries, uris and geometries per uri of the process, set by load_targets
+tree = None
+target_uris = None
+target_counts = None
+
+
+def is_available():
+    return shapely is not None and int(shapely.__version__.split('.')[0]) >= 2
+
+
+# Maps source and target geometries in process, without the database. Both sides are lists of (uri, WKB) rows. The
+# targets are put into an STRtree once per worker process and the sources are queried against it in partitions, with
+# the relation as the tree's predicate where GEOS has one. Yields the links of every partition as a list of
+# (source_uri, relation, target_uri, distance), compact disjoint links with the list of target uris the source is not
+# disjoint from in place of the target uri.
+def map_geometries(sources, targets, relations, threshold=None, k=None, workers=1, compact=False):
+    uris = [row[0] for row in targets]
+    wkbs = [row[1] for row in targets]
+    partitions = get_partitions(sources)
+
+    if workers == 1:
+        load_targets(uris, wkbs)
+
+        for partition in partitions:
+            links = map_partition(partition, relations, threshold, k, compact)
+
+            if len(links) > 0:
+                yield links
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=load_targets, initargs=(uris, wkbs)) as executor:
+            futures = [executor.submit(map_partition, partition, relations, threshold, k, compact) for partition in partitions]
+
+            for future in as_completed(futures):
+                links = future.result()
+
+                if len(links) > 0:
+                    yield links
+
+
+def get_partitions(sources):
+    # Splits the sources into partitions of about PARTITION_SIZE rows. The rows of a uri stay in one partition, so
+    # links can be de-duplicated per partition.
+    sources = sorted(sources, key=lambda row: row[0])
+    partitions = []
+    start = 0
+
+    while start < len(sources):
+        end = min(start + PARTITION_SIZE, len(sources))
+
+        while end < len(sources) and sources[end][0] == sources[end - 1][0]:
+            end += 1
+
+        partitions.append(([row[0] for row in sources[start:end]], [row[1] for row in sources[start:end]]))
+        start = end
+
+    return partitions
+
+
+def load_targets(uris, wkbs):
+    global tree, target_uris, target_counts
+    target_uris = uris
+    target_counts = Counter(uris)
+    tree = shapely.STRtree(shapely.from_wkb(wkbs))
+
+
+def map_partition(partition, relations, threshold, k, compact=False):
+    uris, wkbs = partition
+    geometries = shapely.from_wkb(wkbs)
+    relation = relations[0]
+
+    if len(relations) > 1:
+        # Every relation of a list implies intersection, so all of them are tested on the intersecting pairs
+        source_index, target_index = tree.query(geometries, predicate='intersects')
+        links = []
+
+        for relation in relations:
+            holds = getattr(shapely, relation)(geometries[source_index], tree.geometries[target_index])
+            links += get_links(uris, relation, source_index[holds], target_index[holds])
+
+        return get_unique(links)
+    elif relation == 'distance' or relation == 'hausdorff_distance':
+        if k is not None:
+            return map_nearest(uris, geometries, relation, threshold, k)
+
+        # The Hausdorff distance is never smaller than the distance, so the threshold prunes both
+        source_index, target_index = tree.query(geometries, predicate='dwithin', distance=threshold)
+        distances = measure(relation, geometries[source_index], tree.geometries[target_index])
+
+        if relation == 'hausdorff_distance':
+            within = distances <= threshold
+            source_index, target_index, distances = source_index[within], target_index[within], distances[within]
+
+        return get_links(uris, relation, source_index, target_index, distances)
+    elif relation == 'disjoint':
+        if compact:
+            return map_not_disjoint(uris, geometries)
+
+        return get_unique(map_disjoint(uris, geometries))
+    elif relation == 'equals':
+        source_index, target_index = tree.query(geometries, predicate='intersects')
+        holds = shapely.equals(geometries[source_index], tree.geometries[target_index])
+        source_index, target_index = source_index[holds], target_index[holds]
+    elif relation == 'distance_within':
+        source_index, target_index = tree.query(geometries, predicate='dwithin', distance=threshold)
+    else:
+        source_index, target_index = tree.query(geometries, predicate=relation)
+
+    return get_unique(get_links(uris, relation, source_index, target_index))
+
+
+def map_disjoint(uris, geometries):
+    # Links every source with all targets it does not intersect
+    source_index, target_index = tree.query(geometries, predicate='intersects')
+    order = numpy.argsort(source_index, kind='stable')
+    intersecting = numpy.split(target_index[order], numpy.cumsum(numpy.bincount(source_index, minlength=len(geometries)))[:-1])
+    all_targets = numpy.arange(len(tree.geometries))
+    links = []
+
+    for index, targets in enumerate(intersecting):
+        disjoint = numpy.setdiff1d(all_targets, targets)
+        links += get_links(uris, 'disjoint', numpy.full(len(disjoint), index), disjoint)
+
+    return links
+
+
+def map_not_disjoint(uris, geometries):
+    # Links every source uri with the target uris all of whose geometries intersect all of its geometries
+    source_index, target_index = tree.query(geometries, predicate='intersects')
+    source_counts = Counter(uris)
+    intersecting = Counter((uris[source], target_uris[target]) for source, target in zip(source_index.tolist(), target_index.tolist()))
+    not_disjoint = dict((uri, []) for uri in uris)
+
+    for (source_uri, target_uri), count in intersecting.items():
+        if count == source_counts[source_uri] * target_counts[target_uri]:
+            not_disjoint[source_uri].append(target_uri)
+
+    return [(uri, 'disjoint', sorted(targets), None) for uri, targets in not_disjoint.items()]
+
+
+def map_nearest(uris, geometries, relation, threshold, k):
+    # Links every source with its k nearest targets (within the threshold, if one is given). Hausdorff distances are
+    # ranked by computing them for all candidates, as in the PostGIS query.
+    count = len(tree.geometries)
+    links = []
+
+    if count == 0:
+        return links
+
+    bounds = shapely.total_bounds(tree.geometries)
+    spacing = max(bounds[2] - bounds[0], bounds[3] - bounds[1]) / count ** 0.5
+
+    for index, geometry in enumerate(geometries):
+        if threshold is not None:
+            candidates = tree.query(geometry, predicate='dwithin', distance=threshold)
+        elif relation == 'distance':
+            candidates = find_nearest_candidates(geometry, k, spacing)
+        else:
+            candidates = numpy.arange(count)
+
+        distances = measure(relation, geometry, tree.geometries[candidates])
+        nearest = numpy.argsort(distances, kind='stable')[:k]
+        links += get_links(uris, relation, numpy.full(len(nearest), index), candidates[nearest], distances[nearest])
+
+    return links
+
+
+def find_nearest_candidates(geometry, k, spacing):
+    # Widens the search radius from the nearest target until at least k targets are within it, the k nearest targets
+    # are then among them
+    count = len(tree.geometries)
+    _, distances = tree.query_nearest(geometry, return_distance=True)
+    radius = max(distances[0], spacing)
+
+    while True:
+        candidates = tree.query(geometry, predicate='dwithin', distance=radius)
+
+        if len(candidates) >= min(k, count):
+            return candidates
+
+        radius = radius * 2 or 1.0
+
+
+def measure(relation, source_geometries, target_geometries):
+    if relation == 'distance':
+        return shapely.distance(source_geometries, target_geometries)
+
+    return shapely.hausdorff_distance(source_geometries, target_geometries)
+
+
+def get_links(uris, relation, source_index, target_index, distances=None):
+    if distances is None:
+        return [(uris[source], relation, target_uris[target], None) for source, target in zip(source_index.tolist(), target_index.tolist())]
+
+    return [(uris[source], relation, target_uris[target], distance)
+            for source, target, distance in zip(source_index.tolist(), target_index.tolist(), distances.tolist())]
+
+
+def get_unique(links):
+    # A uri with several geometries can be related more than once, like the DISTINCT of the PostGIS queries
+    seen = set()
+    unique_links = []
+
+    for link in links:
+        if link not in seen:
+            seen.add(link)
+            unique_links.append(link)
+
+    return unique_links
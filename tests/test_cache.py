@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import Cache
+from catalog import CacheCatalog
+from tracer import Tracer
+
+QUERY_HASH = '0123456789abcdef0123456789abcdef'
+BATCH = 7
+
+
+class Config:
+    def get_geo_coding(self, type):
+        return None
+
+    def get_var_uri(self, type):
+        return 'uri'
+
+    def get_var_shape(self, type):
+        return 'shape'
+
+    def get_endpoint(self, type):
+        return 'http://example.org/sparql'
+
+
+class Sparql:
+    query_hash = QUERY_HASH
+
+
+# Records the statements of a connection and which of them were committed
+class Connection:
+    def __init__(self):
+        self.pending = []
+        self.committed = []
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.committed += self.pending
+        self.pending = []
+
+    def rollback(self):
+        self.pending = []
+
+
+class Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+
+    def execute(self, query, parameters=None):
+        self.connection.pending.append((' '.join(query.split()), parameters))
+        self.rowcount = 3 if query.strip().startswith('INSERT') else -1
+
+    def fetchone(self):
+        return (BATCH,)
+
+
+def get_cache():
+    cache = Cache.__new__(Cache)
+    cache.config = Config()
+    cache.sparql = Sparql()
+    cache.type = 'source'
+    cache.catalog = CacheCatalog({})
+    cache.tracer = Tracer()
+    cache.batch = None
+
+    return cache
+
+
+def get_versions(statements):
+    return [parameters[1] for query, parameters in statements if query.startswith('INSERT INTO cache_catalog') and 'version' in query]
+
+
+def test_version_is_committed_with_the_members_of_a_failed_run():
+    cache = get_cache()
+    connection = Connection()
+    cursor = connection.cursor()
+
+    # The first chunk is committed, the second one fails before its commit
+    cache.insert_staged(cursor)
+    connection.commit()
+
+    with pytest.raises(RuntimeError):
+        cache.insert_staged(cursor)
+        raise RuntimeError('retries exhausted')
+
+    connection.rollback()
+
+    members = [parameters['batch'] for query, parameters in connection.committed if query.startswith('INSERT INTO members_')]
+    assert members == [BATCH]
+    assert get_versions(connection.committed) == [BATCH]
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Depth of the finest grid the quadtree is built on, which has 2^MAX_DEPTH cells per side
+MAX_DEPTH = 8
+
+
+# Builds a quadtree over the cells of the finest grid. counts holds the number of geometries per (column, row) cell,
+# counted by the centre of their bbox. A tile is split into four while it holds more than max_rows geometries and is
+# larger than one cell. Returns the leaves as (column, row, size) in cells, ordered by column and row.
+def build_quadtree(counts, max_rows, depth=MAX_DEPTH):
+    size = 2 ** depth
+    sums = [[0] * (size + 1) for _ in range(size + 1)]
+
+    for (column, row), count in counts.items():
+        sums[column + 1][row + 1] += count
+
+    for column in range(1, size + 1):
+        for row in range(1, size + 1):
+            sums[column][row] += sums[column - 1][row] + sums[column][row - 1] - sums[column - 1][row - 1]
+
+    leaves = []
+    tiles = [(0, 0, size)]
+
+    while len(tiles) > 0:
+        column, row, tile_size = tiles.pop()
+        count = (sums[column + tile_size][row + tile_size] - sums[column][row + tile_size] - sums[column + tile_size][row]
+                 + sums[column][row])
+
+        if tile_size == 1 or count <= max_rows:
+            leaves.append((column, row, tile_size))
+        else:
+            half = tile_size // 2
+            tiles += [(column, row, half), (column + half, row, half), (column, row + half, half), (column + half, row + half, half)]
+
+    return sorted(leaves)
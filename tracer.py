@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import join
+from threading import Lock
+
+import json
+import time
+
+
+# Structured timings of a run. Every span has a stage (cache_check, download, copy, geometry_parse, join, fetch,
+# format, ...), its start in seconds since the run started, its duration and attributes such as rows and bytes. Spans
+# of concurrent downloads and partitions are added from several threads. With a query hash the trace is written as
+# JSON to logs/<query hash>.trace.json, together with totals per stage and the captured query plans.
+class Tracer:
+    def __init__(self, query_hash=None):
+        self.query_hash = query_hash
+        self.started_at = time.time()
+        self.spans = []
+        self.plans = []
+        self.lock = Lock()
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        # Yields the attributes, so rows and bytes that are only known at the end can be added to them
+        start = time.time()
+
+        try:
+            yield attributes
+        finally:
+            self.add(stage, start, time.time() - start, **attributes)
+
+    def add(self, stage, start, duration, **attributes):
+        span = dict(stage=stage, start=round(start - self.started_at, 6), duration=round(duration, 6), **attributes)
+
+        with self.lock:
+            self.spans.append(span)
+
+    def iterate(self, stage, batches, **attributes):
+        # Passes the batches through and records the time their consumer spends on them, and their rows, as one span
+        start = time.time()
+        duration = 0
+        rows = 0
+
+        for batch in batches:
+            resumed = time.time()
+            yield batch
+            duration += time.time() - resumed
+            rows += len(batch)
+
+        self.add(stage, start, duration, rows=rows, **attributes)
+
+    def add_plan(self, query, plan):
+        with self.lock:
+            self.plans.append({'query': query, 'plan': plan})
+
+    def get_summary(self):
+        summary = {}
+
+        for span in self.spans:
+            stage = summary.setdefault(span['stage'], {'count': 0, 'duration': 0, 'rows': 0, 'bytes': 0})
+            stage['count'] += 1
+            stage['duration'] = round(stage['duration'] + span['duration'], 6)
+            stage['rows'] += span.get('rows') or 0
+            stage['bytes'] += span.get('bytes') or 0
+
+        return summary
+
+    def write(self):
+        # Returns the path of the trace, None if the tracer has no query hash
+        if self.query_hash is None:
+            return None
+
+        path = join('logs', '{}.trace.json'.format(self.query_hash))
+
+        with self.lock, open(path, 'w') as trace_file:
+            json.dump({
+                'query_hash': self.query_hash,
+                'started_at': datetime.fromtimestamp(self.started_at).isoformat(),
+                'duration': round(time.time() - self.started_at, 6),
+                'stages': self.get_summary(),
+                'spans': sorted(self.spans, key=lambda span: span['start']),
+                'plans': self.plans
+            }, trace_file, indent=2, default=str)
+
+        return path
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from http.client import BadStatusLine, HTTPConnection, HTTPSConnection
+from io import BufferedReader, RawIOBase
+from queue import Empty, LifoQueue
+from threading import Lock
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urljoin, urlsplit, urlunsplit
+
+import time
+
+# Redirects followed for one query, as urllib did for SPARQLWrapper
+MAX_REDIRECTS = 5
+
+sessions = {}
+sessions_lock = Lock()
+
+
+# One session per scheme and host, so source and target share their connections when they query the same server
+def get_session(endpoint):
+    parts = urlsplit(endpoint)
+
+    with sessions_lock:
+        if (parts.scheme, parts.netloc) not in sessions:
+            sessions[(parts.scheme, parts.netloc)] = Session(parts.scheme, parts.netloc)
+
+        return sessions[(parts.scheme, parts.netloc)]
+
+
+# Pool of keep-alive connections to one SPARQL server
+class Session:
+    def __init__(self, scheme, netloc):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.connections = LifoQueue()
+
+    def acquire(self, timeout=None):
+        try:
+            connection = self.connections.get_nowait()
+            connection.timeout = timeout
+
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+
+            return connection, True
+        except Empty:
+            if self.scheme == 'https':
+                return HTTPSConnection(self.netloc, timeout=timeout), False
+
+            return HTTPConnection(self.netloc, timeout=timeout), False
+
+    def release(self, connection):
+        self.connections.put(connection)
+
+    def query(self, endpoint, query, timeout=None):
+        parts = urlsplit(endpoint)
+        parameters = [('query', query), ('format', 'csv'), ('output', 'csv'), ('results', 'csv')]
+
+        return self.get(urlunsplit((parts.scheme, parts.netloc, parts.path or '/', '&'.join(filter(None, [parts.query, urlencode(parameters)])),
+                                    '')), timeout)
+
+    def get(self, url, timeout=None, redirects=0):
+        # Redirects are followed through the session of their host, any other status than 2xx raises an HTTPError
+        parts = urlsplit(url)
+        path = '{}?{}'.format(parts.path or '/', parts.query) if parts.query else parts.path or '/'
+        headers = {'Accept': 'text/csv', 'Accept-Encoding': 'gzip', 'Connection': 'keep-alive', 'User-Agent': 'geo-L'}
+
+        while True:
+            connection, reused = self.acquire(timeout)
+            timing = {'reused': reused, 'connect': 0}
+            start = time.time()
+
+            try:
+                if not reused:
+                    connection.connect()
+                    timing['connect'] = time.time() - start
+
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (BadStatusLine, ConnectionError):
+                connection.close()
+
+                # The server closed an idle keep-alive connection, try again with the next one
+                if reused:
+                    continue
+
+                raise
+            except Exception:
+                connection.close()
+                raise
+
+            timing['response'] = time.time() - start
+
+            if 300 <= response.status < 400 and 'location' in response.headers and redirects < MAX_REDIRECTS:
+                location = urljoin(url, response.headers['location'])
+                response.read()
+                self.finish(connection, response)
+
+                return get_session(location).get(location, timeout, redirects + 1)
+
+            if response.status < 200 or response.status >= 300:
+                error = HTTPError(url, response.status, response.reason, response.headers, None)
+                response.read()
+                self.finish(connection, response)
+                raise error
+
+            return SPARQLResponse(BufferedReader(PooledResponse(self, connection, response)), response.headers, timing)
+
+    def finish(self, connection, response):
+        if response.isclosed() and not response.will_close:
+            self.release(connection)
+        else:
+            connection.close()
+
+
+# Body of a pooled response, the connection goes back to the session once the body is closed
+class PooledResponse(RawIOBase):
+    def __init__(self, session, connection, response):
+        self.session = session
+        self.connection = connection
+        self.response = response
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.response.readinto(buffer)
+
+    def close(self):
+        if not self.closed:
+            self.session.finish(self.connection, self.response)
+
+        super().close()
+
+
+# Mimics the parts of SPARQLWrapper's QueryResult used by the cache
+class SPARQLResponse:
+    def __init__(self, response, headers, timing):
+        self.response = response
+        self.headers = headers
+        self.timing = timing
+
+    def info(self):
+        return self.headers